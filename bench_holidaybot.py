@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""Benchmarks the main HolidayBot operations against a synthetic directory,
+leave list and HipChat user list served from a local stub server, reporting
+throughput and p50/p99 latency for each.
+
+    python3 bench_holidaybot.py [--employees N] [--latency-ms MS] ...
+"""
+import argparse
+import random
+import re
+import time
+
+from bench_stub_server import (StubServer, make_directory,
+                               make_hipchat_users, make_leaves)
+from types import SimpleNamespace
+
+def measure(name, fn, inputs, iterations):
+    '''Calls FN on each of ITERATIONS inputs drawn from INPUTS in turn and
+    prints throughput and latency percentiles'''
+    samples = []
+    for i in range(iterations):
+        arg = inputs[i % len(inputs)]
+        started = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    print('{:<28} {:>7} {:>12.0f} {:>10.3f} {:>10.3f}'.format(
+        name, iterations, len(samples) / sum(samples),
+        samples[len(samples) // 2] * 1000,
+        samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000))
+
+def make_plugin(checker, users):
+    '''A HolidayBot with just enough state to handle messages, without an
+    errbot instance behind it'''
+    import holidaybot
+    plugin = holidaybot.HolidayBot.__new__(holidaybot.HolidayBot)
+    plugin.checker = checker
+    plugin.mentions = {user['mention_name'].lower(): user['name']
+                       for user in users}
+    return plugin
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--employees', type=int, default=10000)
+    parser.add_argument('--leave-fraction', type=float, default=0.05,
+                        help="Fraction of employees with leave booked")
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="Latency of each stub server response")
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    employees = make_directory(args.employees, rng)
+    leaves = make_leaves(employees, args.leave_fraction, rng)
+    users = make_hipchat_users(employees)
+    server = StubServer(employees, leaves, users,
+                        latency=args.latency_ms / 1000).start()
+
+    import holidaybot
+    whosout = holidaybot.whosout
+    print('{} employees, {} leaves, {:.0f}ms stub latency\n'.format(
+        len(employees), len(leaves), args.latency_ms))
+    print('{:<28} {:>7} {:>12} {:>10} {:>10}'.format(
+        'operation', 'calls', 'ops/s', 'p50 ms', 'p99 ms'))
+    few = max(1, args.iterations // 100)
+
+    measure('WhosOutChecker (cold load)',
+            lambda _: whosout.WhosOutChecker('key', server.company,
+                                             server.host),
+            [None], few)
+    checker = whosout.WhosOutChecker('key', server.company, server.host)
+    measure('_build_namesets', whosout.WhosOutChecker._build_namesets,
+            [checker.emps], few)
+
+    names = [e['firstName'] for e in employees[:200]] + \
+            [e['displayName'] for e in employees[200:400]] + \
+            ['Nobody{}'.format(i) for i in range(50)] + \
+            [e['lastName'][:-1] for e in employees[400:450]] # typos
+    rng.shuffle(names)
+    measure('where_is', checker.where_is, names, args.iterations)
+    measure('where_is (leaves uncached)',
+            lambda name: (checker.leaves.invalidate(),
+                          checker.where_is(name)),
+            names, few)
+    measure('get_whos_out', lambda _: checker.get_whos_out(), [None],
+            args.iterations)
+    whos_out = checker.get_whos_out()
+    measure('build_whosout_reply', whosout.build_whosout_reply,
+            [whos_out], args.iterations)
+    measure('get_whos_out_reply', lambda _: checker.get_whos_out_reply(),
+            [None], args.iterations)
+    teams = sorted({e['department'] for e in employees} |
+                   {e['location'] for e in employees})
+    measure('whos_out_in', checker.whos_out_in, teams, args.iterations)
+
+    plugin = make_plugin(checker, users)
+    messages = []
+    for i in range(100):
+        mentioned = rng.sample(users, rng.randint(1, 15))
+        body = 'standup: ' + ' '.join('@' + u['mention_name']
+                                      for u in mentioned)
+        messages.append((SimpleNamespace(body=body),
+                         list(re.finditer(holidaybot.AT_MENTION_PATTERN,
+                                                    body))))
+    measure('listen_for_at_mentions',
+            lambda message: plugin.listen_for_at_mentions(*message),
+            messages, args.iterations)
+    server.stop()
+
+if __name__ == '__main__':
+    main()
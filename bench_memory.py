@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""Compares the memory held by the employees directory and namesets as
+plain strings with sets of ids per name, against interned strings with
+sorted arrays of ids, for synthetic directories of several sizes.
+
+    python3 bench_memory.py [--employees N ...]
+"""
+import argparse
+import gc
+import json
+import random
+import re
+import tracemalloc
+
+from bench_stub_server import make_directory
+from bhr_client import EMPLOYEE_JSON_FIELDS, BambooHrClient, Employee
+from collections import defaultdict
+from whosout import WhosOutChecker, _normalise_name
+
+def _directory_json(n, rng):
+    return json.dumps({'employees': make_directory(n, rng)})
+
+def _build_plain(emps_json):
+    '''The directory and namesets as they were: plain strings, sets of ids'''
+    emps = {int(e['id']): Employee(*map(e.get, EMPLOYEE_JSON_FIELDS))
+            for e in emps_json}
+    namesets = defaultdict(set)
+    for emp_id, emp in emps.items():
+        names = sum((re.split('[ -]', _normalise_name(name))
+                     for name in (emp.display, emp.first, emp.last, emp.nick)
+                     if name is not None), [])
+        for name in names:
+            namesets[name].add(emp_id)
+    return emps, namesets
+
+def _build_compact(emps_json):
+    emps = {int(e['id']): BambooHrClient._get_employee_from_json(e)
+            for e in emps_json}
+    return emps, WhosOutChecker._build_namesets(emps)
+
+def _retained(build, text):
+    '''Bytes still allocated by BUILD once the parsed JSON has been freed'''
+    gc.collect()
+    tracemalloc.start()
+    emps_json = json.loads(text)['employees']
+    result = build(emps_json)
+    del emps_json
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--employees', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    args = parser.parse_args()
+    rng = random.Random(42)
+    print('{:>9} {:>12} {:>12} {:>8}'.format(
+        'employees', 'plain', 'compact', 'saving'))
+    for n in args.employees:
+        text = _directory_json(n, rng)
+        plain = _retained(_build_plain, text)
+        compact = _retained(_build_compact, text)
+        print('{:>9} {:>9.2f} MB {:>9.2f} MB {:>7.0%}'.format(
+            n, plain / 2**20, compact / 2**20, 1 - compact / plain))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+"""Measures name normalisation throughput over a synthetic corpus of
+employee names (a mix of common, unicode and hyphenated ones), both for
+building the namesets and for names typed into queries.
+
+    python3 bench_normalise.py [--names N] [--distinct-queries N] ...
+"""
+import argparse
+import random
+import time
+
+from bench_stub_server import make_directory
+from bhr_client import BambooHrClient
+
+def throughput(name, fn, items, repeat):
+    '''Calls FN on every one of ITEMS, REPEAT times, and prints the best
+    items per second'''
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<32} {:>8} {:>12.0f} {:>10.1f}'.format(
+        name, len(items), len(items) / best, best * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--names', type=int, default=50000,
+                        help="Employee names in the corpus")
+    parser.add_argument('--distinct-queries', type=int, default=2000,
+                        help="Distinct names typed, out of --names queries")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    import whosout
+    rng = random.Random(args.seed)
+    # display, first, last and maybe a nickname per employee
+    emps = {i: BambooHrClient._get_employee_from_json(e) for i, e
+            in enumerate(make_directory(args.names // 3, rng))}
+    corpus = [name for emp in emps.values() for name in emp
+              if name is not None]
+    asked = rng.sample(corpus, min(args.distinct_queries, len(corpus)))
+    queries = [rng.choice(asked) for _ in range(args.names)]
+
+    print('{:<32} {:>8} {:>12} {:>10}'.format('operation', 'items', 'per s',
+                                              'ms'))
+    throughput('_split_name (corpus)', whosout._split_name, corpus,
+               args.repeat)
+    throughput('_get_names (employees)', whosout.WhosOutChecker._get_names,
+               list(emps.values()), args.repeat)
+    throughput('_build_namesets', whosout.WhosOutChecker._build_namesets,
+               [emps], args.repeat)
+    whosout._split_typed_name.cache_clear()
+    throughput('_split_typed_name (queries)', whosout._split_typed_name,
+               queries, args.repeat)
+    info = whosout._split_typed_name.cache_info()
+    print('typed name cache: {:.0%} hits'.format(
+        info.hits / (info.hits + info.misses)))
+
+if __name__ == '__main__':
+    main()
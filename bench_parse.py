@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""Compares peak memory and time of parsing the employees directory and
+who's out responses in one go against streaming them through
+bhr_client.iter_json_array, against synthetic responses from a local stub
+server.
+
+    python3 bench_parse.py [--employees N ...]
+"""
+import argparse
+import json
+import random
+import requests
+import time
+import tracemalloc
+
+from bench_stub_server import StubServer, make_directory, make_leaves
+from bhr_client import (EMPLOYEE_JSON_FIELDS, BambooHrClient, Employee,
+                        Leave)
+from datetime import date, datetime
+
+def _get_directory_in_one_go(url):
+    '''How get_employees_directory used to parse the response'''
+    response = requests.get(url, auth=('key', 'pass'),
+                            headers={'Accept': 'application/json'})
+    emps_json = json.loads(response.text)['employees']
+    return {int(e['id']): Employee(*map(e.get, EMPLOYEE_JSON_FIELDS))
+            for e in emps_json}
+
+def _get_timeoffs_in_one_go(url):
+    '''How get_timeoffs used to parse the response'''
+    response = requests.get(url, auth=('key', 'pass'),
+                            headers={'Accept': 'application/json'})
+    def parse(s):
+        return datetime.strptime(s, '%Y-%m-%d').date()
+    return {x['id']: (x['employeeId'], Leave(parse(x['start']),
+                                             parse(x['end'])))
+            for x in json.loads(response.text) if 'employeeId' in x}
+
+def _measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--employees', type=int, nargs='+',
+                        default=[1000, 10000])
+    args = parser.parse_args()
+    print('{:>9} {:>10} {:>14} {:>14} {:>10} {:>10}'.format(
+        'employees', 'endpoint', 'one go peak', 'stream peak',
+        'one go ms', 'stream ms'))
+    rng = random.Random(42)
+    for n in args.employees:
+        employees = make_directory(n, rng)
+        server = StubServer(employees, make_leaves(employees, 1.0, rng)).start()
+        client = BambooHrClient('key', server.company, server.host)
+        base = '{}/api/gateway.php/{}/v1/'.format(server.host, server.company)
+        today = date.today()
+        for endpoint, old, new in [
+                ('directory',
+                 lambda: _get_directory_in_one_go(base + 'employees/directory'),
+                 client.get_employees_directory),
+                ('whos_out',
+                 lambda: _get_timeoffs_in_one_go(base + 'time_off/whos_out/'),
+                 lambda: client.get_timeoffs(today, today))]:
+            old_result, old_peak, old_time = _measure(old)
+            new_result, new_peak, new_time = _measure(new)
+            assert old_result == new_result
+            print('{:>9} {:>10} {:>11.1f} MB {:>11.1f} MB {:>10.1f} {:>10.1f}'
+                  .format(n, endpoint, old_peak / 2**20, new_peak / 2**20,
+                          old_time * 1000, new_time * 1000))
+        server.stop()
+
+if __name__ == '__main__':
+    main()
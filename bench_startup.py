@@ -0,0 +1,130 @@
+#!/usr/bin/python
+"""Measures how long `import holidaybot` and HolidayBot.activate take, the
+latter against a synthetic directory served from a local stub server,
+both with and without a snapshot to restore from.
+
+    python3 bench_startup.py [--employees N] [--repeat N] ...
+"""
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_stub_server import (StubServer, make_directory,
+                               make_hipchat_users, make_leaves)
+from types import SimpleNamespace
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SCRIPT = '''import sys, time
+sys.path.insert(0, {plugin_dir!r})
+import errbot
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+CREDENTIALS = '''[BambooHR]
+ApiKey=key
+Host={host}
+Company={company}
+[HipChat]
+Host={host}
+Token=token
+'''
+
+def time_import(module, repeat):
+    '''Seconds to import MODULE in a fresh interpreter, for each of REPEAT
+    runs. errbot is imported first, so it isn't counted'''
+    script = IMPORT_SCRIPT.format(plugin_dir=PLUGIN_DIR, module=module)
+    return [float(subprocess.check_output([sys.executable, '-c', script],
+                                          cwd=PLUGIN_DIR))
+            for _ in range(repeat)]
+
+def make_plugin(data_dir):
+    '''A HolidayBot with just enough of errbot behind it to activate'''
+    from errbot.storage.memory import MemoryStoragePlugin
+    import holidaybot
+    bot = SimpleNamespace(
+        repo_manager=SimpleNamespace(plugin_dir=PLUGIN_DIR),
+        storage_plugin=MemoryStoragePlugin(None),
+        bot_config=SimpleNamespace(BOT_DATA_DIR=data_dir,
+                                   MESSAGE_SIZE_LIMIT=None,
+                                   BOT_ADMINS=()),
+        inject_commands_from=lambda plugin: None,
+        inject_command_filters_from=lambda plugin: None,
+        remove_commands_from=lambda plugin: None,
+        remove_command_filters_from=lambda plugin: None)
+    return holidaybot.HolidayBot(bot, 'HolidayBot')
+
+def time_activate(data_dir, restoring=False):
+    plugin = make_plugin(data_dir)
+    reconciled = threading.Event()
+    reconcile = plugin.reconcile_with_bamboohr
+    def reconcile_and_signal(config):
+        reconcile(config)
+        reconciled.set()
+    plugin.reconcile_with_bamboohr = reconcile_and_signal
+    started = time.perf_counter()
+    plugin.activate()
+    elapsed = time.perf_counter() - started
+    if restoring:
+        # let reconciling with BambooHR finish before the next sample
+        reconciled.wait(10)
+    plugin.deactivate()
+    return elapsed
+
+def report(name, samples):
+    samples = sorted(samples)
+    print('{:<34} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+        name, samples[0] * 1000, statistics.median(samples) * 1000,
+        samples[-1] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--employees', type=int, default=10000)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="Latency of each stub server response")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print('{:<34} {:>9} {:>9} {:>9}'.format('', 'min ms', 'median ms',
+                                            'max ms'))
+    report('import holidaybot', time_import('holidaybot', args.repeat))
+    report('import whosout', time_import('whosout', args.repeat))
+
+    rng = random.Random(args.seed)
+    employees = make_directory(args.employees, rng)
+    server = StubServer(employees, make_leaves(employees, 0.05, rng),
+                        make_hipchat_users(employees),
+                        latency=args.latency_ms / 1000).start()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        with open(os.path.join(work_dir, 'holidaybot_credentials.cfg'),
+                  'w') as f:
+            f.write(CREDENTIALS.format(host=server.host,
+                                       company=server.company))
+        os.chdir(work_dir) # activate reads the credentials from here
+        try:
+            cold = []
+            for i in range(args.repeat):
+                data_dir = os.path.join(work_dir, 'cold{}'.format(i))
+                os.mkdir(data_dir)
+                cold.append(time_activate(data_dir))
+            report('activate (fetching from BambooHR)', cold)
+            # the last cold activation left a snapshot behind
+            report('activate (from snapshot)',
+                   [time_activate(data_dir, restoring=True)
+                    for _ in range(args.repeat)])
+        finally:
+            os.chdir(cwd)
+    server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Synthetic BambooHR and HipChat data, served from a local stub server with
+configurable latency, for the benchmarks"""
+import bottle
+import threading
+import time
+
+from datetime import date, timedelta
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer',
+               'Michael', 'Linda', 'William', 'Elizabeth', 'David', 'Zoë',
+               'Mary-Jane', 'José', 'Siobhán', 'Wei', 'Aarav', 'Fatima',
+               'Jean-Luc', 'Björn', 'Chloé', 'Łukasz']
+LAST_NAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Taylor', 'Davies',
+              'Evans', 'Wilson', 'Thomas', 'Müller', 'Nguyen', 'García',
+              'Smith-Jones', "O'Brien", 'Kowalski', 'Chen', 'Patel', 'Khan',
+              'Østergaard', 'Lloyd-Webber']
+DEPARTMENTS = ['Engineering', 'Sales', 'Marketing', 'Finance', 'People',
+               'Research', 'Support', 'Legal']
+LOCATIONS = ['London', 'San Francisco', 'Seoul', 'Beijing']
+
+def make_directory(n, rng):
+    '''N employee records as in the employees/directory response. Names are
+    a mix of common, unicode and hyphenated names with a long tail of rarer
+    ones'''
+    employees = []
+    for i in range(n):
+        first = rng.choice(FIRST_NAMES) if rng.random() < 0.7 \
+                else 'First{}'.format(rng.randrange(n // 4 + 1))
+        last = rng.choice(LAST_NAMES) if rng.random() < 0.5 \
+               else 'Last{}'.format(rng.randrange(n // 2 + 1))
+        employees.append({
+            'id': str(i + 1000),
+            'displayName': first + ' ' + last,
+            'firstName': first,
+            'lastName': last,
+            'nickname': first[:3] if rng.random() < 0.1 else None,
+            'jobTitle': 'Software Engineer',
+            'workEmail': 'employee{}@example.com'.format(i),
+            'department': rng.choice(DEPARTMENTS),
+            'division': 'Division {}'.format(i % 5),
+            'location': rng.choice(LOCATIONS),
+            'photoUploaded': False})
+    return employees
+
+def make_leaves(employees, fraction, rng, today=None, days=28):
+    '''Leaves, as in the time_off/whos_out response, for about FRACTION of
+    EMPLOYEES, starting within DAYS of TODAY'''
+    today = today or date.today()
+    leaves = []
+    for e in employees:
+        if rng.random() >= fraction:
+            continue
+        start = today + timedelta(rng.randrange(-3, days))
+        end = start + timedelta(rng.randrange(0, 10))
+        leaves.append({'id': len(leaves) + 1, 'type': 'timeoff',
+                       'employeeId': int(e['id']), 'name': e['displayName'],
+                       'start': str(start), 'end': str(end)})
+    return leaves
+
+def make_hipchat_users(employees):
+    '''HipChat users, one per employee, with mention names like JamesSmith'''
+    return [{'id': i,
+             'mention_name': ''.join(c for c in e['displayName']
+                                     if c.isalnum()) + str(i),
+             'name': e['displayName']}
+            for i, e in enumerate(employees)]
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class StubServer(object):
+    '''Serves EMPLOYEES, LEAVES and USERS as BambooHR and HipChat would,
+    waiting LATENCY seconds before each response'''
+
+    def __init__(self, employees, leaves, users=(), latency=0.0,
+                 company='bench', port=0):
+        self.company = company
+        self.latency = latency
+        self.requests = 0
+        # encoded up front, so serving doesn't skew measurements in-process
+        directory = bottle.json_dumps({'fields': [], 'employees': employees})
+        leaves = bottle.json_dumps(leaves)
+        app = bottle.Bottle()
+        base = '/api/gateway.php/' + company + '/v1/'
+        app.route(base + 'employees/directory',
+                  callback=lambda: self._respond(directory))
+        app.route(base + 'time_off/whos_out/',
+                  callback=lambda: self._respond(leaves))
+        app.route('/v2/user', callback=lambda: self._respond(
+            bottle.json_dumps(self._page(users))))
+        self._server = make_server('localhost', port, app,
+                                   server_class=_ThreadingWSGIServer,
+                                   handler_class=_QuietHandler)
+        self.host = 'http://localhost:{}'.format(self._server.server_port)
+
+    def _page(self, users):
+        start = int(bottle.request.query.get('start-index', 0))
+        size = int(bottle.request.query.get('max-results', 100))
+        return {'items': users[start:start + size]}
+
+    def _respond(self, body):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        bottle.response.content_type = 'application/json'
+        return body
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
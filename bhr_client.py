@@ -1,46 +1,430 @@
 """Simple wrapper for BambooHR API calls"""
+import asyncio
 import json
+import random
 import requests
+import sys
+import threading
+import time
 from collections import namedtuple
-from datetime import date, datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from metrics import METRICS
+from requests.adapters import HTTPAdapter
 
-Employee = namedtuple("Employee", "display first last nick")
+# the first four fields are names an employee may be referred to by, the
+# rest the teams they belong to
+Employee = namedtuple("Employee", "display first last nick department "
+                      "division location", defaults=(None, None, None))
 Leave = namedtuple("Leave", "start end")
+# the directory fields read into each of Employee's fields, in order
+EMPLOYEE_JSON_FIELDS = ('displayName', 'firstName', 'lastName', 'nickname',
+                        'department', 'division', 'location')
+
+CHUNK_SIZE = 64 * 1024 # bytes of response body decoded at a time
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (3.05, 10) # (connect, read) seconds
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5 # seconds, doubled for each retry
+MAX_VALIDATED_RESPONSES = 8 # parsed responses kept for conditional GETs
+# BambooHR doesn't publish its limits, so stay well under what it tolerates
+DEFAULT_RATE = 5 # requests per second
+DEFAULT_BURST = 10 # requests
+DEFAULT_INTERACTIVE_RESERVE = 2 # tokens background requests leave spare
+MAX_RETRY_AFTER = 60 # seconds, however long a 429 asks us to wait
+
+# request priorities: someone is waiting on the reply, or nobody is
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+def parse_retry_after(value, default):
+    """Seconds to wait from a Retry-After header VALUE, either a number of
+    seconds or an HTTP date, capped at MAX_RETRY_AFTER. DEFAULT if there is
+    no usable value"""
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) -
+                       datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+class RateLimiter(object):
+    """Token bucket shared by the requests to one API, refilling at RATE
+    tokens a second up to BURST. Interactive requests are let through ahead
+    of any background ones waiting, and background requests leave RESERVE
+    tokens spare for them. Everyone holds off while the server has asked us
+    to (see defer)"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 reserve=DEFAULT_INTERACTIVE_RESERVE, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = clock()
+        self._deferred_until = 0.0
+        self._interactive_waiting = 0
+
+    def acquire(self, priority=INTERACTIVE):
+        """Blocks until a request of PRIORITY may be sent"""
+        started = None
+        with self._condition:
+            if priority == INTERACTIVE:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    wait = self._get_wait(priority)
+                    if wait == 0:
+                        self._tokens -= 1
+                        break
+                    if started is None:
+                        started = self._clock()
+                    self._condition.wait(wait)
+            finally:
+                if priority == INTERACTIVE:
+                    self._interactive_waiting -= 1
+                    self._condition.notify_all()
+        if started is not None:
+            METRICS.observe('rate_limit_wait_' + PRIORITY_NAMES[priority],
+                            self._clock() - started)
+
+    def _get_wait(self, priority):
+        '''Seconds until a request of PRIORITY may go: 0 if it may go now,
+        or None if it must wait for the interactive requests to go first'''
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens +
+                           (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if now < self._deferred_until:
+            return self._deferred_until - now
+        needed = 1
+        if priority == BACKGROUND:
+            if self._interactive_waiting:
+                return None
+            needed += self.reserve
+        if self._tokens >= needed:
+            return 0
+        return (needed - self._tokens) / self.rate
+
+    def defer(self, seconds):
+        """Holds off every request for SECONDS, e.g. as asked by a 429"""
+        with self._condition:
+            self._deferred_until = max(self._deferred_until,
+                                       self._clock() + seconds)
+            self._condition.notify_all()
+
+class HttpClient(object):
+    """Pooled keep-alive HTTP session with timeouts, retrying server and
+    connection errors with jittered exponential backoff, and 429s once the
+    server's Retry-After has passed. If LIMITER (a RateLimiter) is given,
+    requests wait their turn with it"""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 limiter=None):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = limiter
+
+    def get(self, url, priority=INTERACTIVE, **kwargs):
+        """GETs URL, retrying 5xx and 429 responses and connection errors up
+        to max_retries times. PRIORITY is INTERACTIVE or BACKGROUND. Raises
+        HTTPError if the final response is an error"""
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(priority)
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            started = time.monotonic()
+            try:
+                response = self._session.get(url, timeout=self.timeout,
+                                             **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                METRICS.observe('http_request', time.monotonic() - started,
+                                failed=True)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                status = response.status_code
+                METRICS.observe('http_request', time.monotonic() - started,
+                                failed=status >= 500)
+                if (status < 500 and status != 429) \
+                   or attempt >= self.max_retries:
+                    if status != 200:
+                        response.raise_for_status()
+                    return response
+                response.close()
+                if status == 429:
+                    METRICS.incr('http_throttled')
+                    delay = parse_retry_after(
+                        response.headers.get('Retry-After'), delay)
+                    if self.limiter is not None:
+                        # every request holds off, not just this one
+                        self.limiter.defer(delay)
+                        delay = 0
+            METRICS.incr('http_retries')
+            time.sleep(delay)
+            attempt += 1
+
+class _JsonStream(object):
+    """Decodes JSON values one at a time from an iterator of text chunks,
+    only keeping the text not yet decoded"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text = ''
+        self._pos = 0
+        self._exhausted = False
+        self._decoder = json.JSONDecoder()
+
+    def _read_more(self):
+        if self._exhausted:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._exhausted = True
+            return False
+        self._text = self._text[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the
+        end of the stream"""
+        while True:
+            while self._pos < len(self._text) \
+                  and self._text[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._text) or not self._read_more():
+                return self._text[self._pos:self._pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '{}' in JSON stream at '{}'".format(
+                char, self._text[self._pos:self._pos + 20]))
+        self._pos += 1
+
+    def decode(self):
+        """Decodes the next complete value, reading as much as it needs"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._text, self._pos)
+            except ValueError:
+                if not self._read_more():
+                    raise
+                continue
+            # a number may carry on into the next chunk
+            if end < len(self._text) or not self._read_more():
+                self._pos = end
+                return value
+
+def iter_json_array(chunks, key=None):
+    """Yields the items of a JSON array as they are decoded from CHUNKS of
+    text, so the whole document is never held in memory at once. If KEY is
+    given, the array is the value of KEY in a top-level object, and other
+    values in the object are skipped"""
+    stream = _JsonStream(chunks)
+    if key is not None:
+        stream.expect('{')
+        while stream.decode() != key:
+            stream.expect(':')
+            stream.decode()
+            stream.expect(',')
+        stream.expect(':')
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        yield stream.decode()
+        if stream.peek() == ']':
+            return
+        stream.expect(',')
+
+def run_concurrently(*coroutines):
+    """Runs COROUTINES concurrently in a new event loop, blocking until they
+    have all finished. Returns their results in order"""
+    async def gather():
+        return await asyncio.gather(*coroutines)
+    return asyncio.run(gather())
+
+class _Flight(object):
+    """A request in flight, whose result (or error) is shared by everyone
+    who asked for it while it was in flight"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
 
 class BambooHrClient(object):
     """Simple wrapper for getting employees directory and a list of who's out"""
 
-    def __init__(self, api_key, company, host=None):
+    def __init__(self, api_key, company, host=None, http=None):
         self._api_key = api_key
+        self._http = http or HttpClient(limiter=RateLimiter())
         host = host or "https://api.bamboohr.com"
         self._base_url = "{}/api/gateway.php/{}/v1/".format(host, company)
+        # (path, params) -> (ETag, Last-Modified, parsed result), oldest first
+        self._validated = {}
+        self._validated_lock = threading.Lock()
+        # (path, params) -> _Flight for requests in progress
+        self._flights = {}
+        self._flights_lock = threading.Lock()
 
     @staticmethod
     def _get_date_from_string(date_string):
         return datetime.strptime(date_string, '%Y-%m-%d').date()
 
-    def get_timeoff_whosout(self):
-        """Gets a dictionary of current leaves, indexed by employee id"""
-        response = requests.get(
-            self._base_url + "time_off/whos_out/?end=" + str(date.today()),
-            auth=(self._api_key, 'pass'),
-            headers={'Accept': 'application/json'})
-        if response.status_code != 200:
-            response.raise_for_status()
-        leaves_json = json.loads(response.text)
-        return {x['employeeId']: Leave(self._get_date_from_string(x['start']),
-                                       self._get_date_from_string(x['end']))
-                for x in leaves_json if 'employeeId' in x}
-
-    def get_employees_directory(self):
-        """Gets a dictionary of all Employees, indexed by employee id"""
-        response = requests.get(self._base_url + "employees/directory",
-                                auth=(self._api_key, "pass"),
-                                headers={'Accept': 'application/json'})
-        if response.status_code != 200:
-            response.raise_for_status()
-        emps_json = json.loads(response.text)['employees']
-        return {int(e['id']): Employee(e['displayName'],
-                                       e['firstName'],
-                                       e['lastName'],
-                                       e['nickname']) for e in emps_json}
+    def _get_json(self, path, parse, key=None, params=None,
+                  priority=INTERACTIVE):
+        """GETs PATH, passing PARSE an iterator over the items of the JSON
+        array in the response (or in its KEY) as they are read from the
+        connection, and returns what it returns.
+        The response's validators are remembered, so the next GET of the
+        same PATH and PARAMS is conditional; if the server says it is not
+        modified the previous result is returned again, without parsing.
+        Callers asking for the same PATH and PARAMS while a request is in
+        flight wait for, and are given, its result, unless it is a
+        BACKGROUND request and they are INTERACTIVE: they would be held up
+        behind background requests in the rate limiter. PRIORITY is
+        INTERACTIVE or BACKGROUND"""
+        cache_key = (path, tuple(sorted((params or {}).items())))
+        flight_key = (cache_key, priority)
+        # concurrent callers share a single request
+        with self._flights_lock:
+            flight = self._flights.get((cache_key, INTERACTIVE))
+            if flight is None and priority == BACKGROUND:
+                flight = self._flights.get(flight_key)
+            in_flight = flight is not None
+            if not in_flight:
+                flight = self._flights[flight_key] = _Flight()
+        if in_flight:
+            METRICS.incr('bamboohr_coalesced')
+            return flight.wait()
+        try:
+            result = self._fetch_json(cache_key, path, parse, key, params,
+                                      priority)
+        except BaseException as e:
+            flight.finish(error=e)
+            raise
+        else:
+            flight.finish(result)
+        finally:
+            with self._flights_lock:
+                del self._flights[flight_key]
+        return result
+
+    def _fetch_json(self, cache_key, path, parse, key, params, priority):
+        headers = {'Accept': 'application/json',
+                   'Accept-Encoding': 'gzip'}
+        validated = self._validated.get(cache_key)
+        if validated is not None:
+            etag, last_modified, _ = validated
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        response = self._http.get(self._base_url + path,
+                                  stream=True,
+                                  auth=(self._api_key, 'pass'),
+                                  headers=headers,
+                                  params=params,
+                                  priority=priority)
+        try:
+            if response.status_code == 304 and validated is not None:
+                METRICS.cache_hit('bamboohr_not_modified')
+                return validated[2]
+            if validated is not None:
+                METRICS.cache_hit('bamboohr_not_modified', False)
+            response.encoding = response.encoding or 'utf-8'
+            result = parse(iter_json_array(
+                response.iter_content(CHUNK_SIZE, decode_unicode=True), key))
+        finally:
+            response.close()
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with self._validated_lock:
+            self._validated.pop(cache_key, None)
+            if etag is not None or last_modified is not None:
+                self._validated[cache_key] = (etag, last_modified, result)
+                while len(self._validated) > MAX_VALIDATED_RESPONSES:
+                    del self._validated[next(iter(self._validated))]
+        return result
+
+    @METRICS.timed('bamboohr_whos_out')
+    def get_timeoffs(self, start, end, priority=INTERACTIVE):
+        """Gets a dictionary of (employee id, Leave) pairs for every leave
+        overlapping START to END, indexed by time off request id. The same
+        dictionary is returned again if nothing has changed since it was
+        fetched, so it must not be modified"""
+        def parse(leaves_json):
+            return {x.get('id', i): (
+                x['employeeId'],
+                Leave(self._get_date_from_string(x['start']),
+                      self._get_date_from_string(x['end'])))
+                    for i, x in enumerate(leaves_json) if 'employeeId' in x}
+        return self._get_json("time_off/whos_out/", parse,
+                              params={'start': str(start), 'end': str(end)},
+                              priority=priority)
+
+    @METRICS.timed('bamboohr_directory')
+    def get_employees_directory(self, priority=INTERACTIVE):
+        """Gets a dictionary of all Employees, indexed by employee id. The
+        same dictionary is returned again if the directory has not changed
+        since it was fetched, so it must not be modified"""
+        def parse(emps_json):
+            return {int(e['id']): self._get_employee_from_json(e)
+                    for e in emps_json}
+        return self._get_json("employees/directory", parse, 'employees',
+                              priority=priority)
+
+    @staticmethod
+    def _get_employee_from_json(e):
+        # names and teams repeat a lot ("James", "Smith", "Engineering"), so
+        # share one copy of each
+        return Employee(*(sys.intern(name) if name is not None else None
+                          for name in map(e.get, EMPLOYEE_JSON_FIELDS)))
+
+class AsyncBambooHrClient(object):
+    """asyncio interface to a BambooHrClient. Requests run in the event
+    loop's default executor, so several can be in flight at once"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def _run(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, method,
+                                                              *args)
+
+    async def get_timeoffs(self, start, end, priority=INTERACTIVE):
+        return await self._run(self.client.get_timeoffs, start, end, priority)
+
+    async def get_employees_directory(self, priority=INTERACTIVE):
+        return await self._run(self.client.get_employees_directory, priority)
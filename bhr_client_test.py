@@ -0,0 +1,412 @@
+from gevent import monkey
+monkey.patch_all()
+import bhr_client
+import bottle
+import gevent
+import gzip
+import json
+import requests
+import threading
+import time
+import unittest
+
+from bhr_client import BACKGROUND, INTERACTIVE, HttpClient, RateLimiter
+from bottle import route
+from datetime import date, timedelta
+from metrics import METRICS
+
+TEST_API_KEY = 'testapikey'
+TEST_COMPANY = 'reynholm-industries'
+TEST_HOST = 'http://localhost:8080'
+
+TODAY = date.today()
+TOMORROW = TODAY + timedelta(1)
+NEXT_WEEK = TODAY + timedelta(7)
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        FLAKY_RESPONSES[:] = []
+        METRICS.reset()
+        self.http = HttpClient(max_retries=2, backoff=0)
+
+    def retries(self):
+        return METRICS.snapshot()['counters'].get('http_retries', 0)
+
+    def test_get_retries_server_errors(self):
+        FLAKY_RESPONSES[:] = [503, 500]
+        response = self.http.get(TEST_HOST + '/flaky')
+        self.assertEqual('ok', response.text)
+        requests_made = METRICS.snapshot()['timings']['http_request']
+        self.assertEqual(3, requests_made['calls'])
+        self.assertEqual(2, requests_made['errors'])
+        self.assertEqual(2, self.retries())
+
+    def test_get_gives_up_after_max_retries(self):
+        FLAKY_RESPONSES[:] = [503, 503, 503]
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.http.get(TEST_HOST + '/flaky')
+        self.assertEqual(2, self.retries())
+
+    def test_get_does_not_retry_client_errors(self):
+        FLAKY_RESPONSES[:] = [404]
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.http.get(TEST_HOST + '/flaky')
+        self.assertEqual(0, self.retries())
+
+    def test_get_waits_out_429s(self):
+        FLAKY_RESPONSES[:] = [(429, '0.2')]
+        started = time.monotonic()
+        self.assertEqual('ok', self.http.get(TEST_HOST + '/flaky').text)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(1, self.retries())
+
+    def test_429s_hold_off_every_request_with_a_limiter(self):
+        limiter = RateLimiter()
+        http = HttpClient(max_retries=2, backoff=0, limiter=limiter)
+        FLAKY_RESPONSES[:] = [(429, '0.2')]
+        started = time.monotonic()
+        self.assertEqual('ok', http.get(TEST_HOST + '/flaky').text)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        started = time.monotonic()
+        limiter.defer(0.1)
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(3.0, bhr_client.parse_retry_after('3', 1))
+        self.assertEqual(1, bhr_client.parse_retry_after(None, 1))
+        self.assertEqual(1, bhr_client.parse_retry_after('soon', 1))
+        self.assertEqual(0.0, bhr_client.parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT', 1))
+        self.assertEqual(bhr_client.MAX_RETRY_AFTER,
+                         bhr_client.parse_retry_after('86400', 1))
+
+    def test_get_retries_connection_errors(self):
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.http.get('http://localhost:1/')
+        self.assertEqual(2, self.retries())
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_bursts_then_limits_rate(self):
+        limiter = RateLimiter(rate=20, burst=2, reserve=0)
+        started = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_background_leaves_reserve_for_interactive(self):
+        limiter = RateLimiter(rate=0.01, burst=3, reserve=1)
+        limiter.acquire(BACKGROUND)
+        limiter.acquire(BACKGROUND)
+        self.assertGreater(limiter._get_wait(BACKGROUND), 0)
+        limiter.acquire(INTERACTIVE)
+        self.assertGreater(limiter._get_wait(INTERACTIVE), 0)
+
+    def test_interactive_goes_ahead_of_waiting_background(self):
+        limiter = RateLimiter(rate=10, burst=1, reserve=0)
+        limiter.acquire(BACKGROUND)
+        order = []
+        def acquire(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+        background = threading.Thread(target=acquire, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.02) # background is waiting for the next token
+        acquire(INTERACTIVE)
+        background.join()
+        self.assertEqual([INTERACTIVE, BACKGROUND], order)
+
+class TestThrottling(unittest.TestCase):
+
+    def setUp(self):
+        THROTTLED_REQUESTS[:] = []
+        THROTTLED_RESPONSES[:] = ['0.3']
+        self.client = bhr_client.BambooHrClient(
+            TEST_API_KEY, THROTTLED_COMPANY, TEST_HOST,
+            HttpClient(backoff=0, limiter=RateLimiter(rate=20, burst=1,
+                                                      reserve=0)))
+
+    def test_interactive_requests_served_first_when_throttled(self):
+        days = [TODAY + timedelta(i) for i in range(5)]
+        background = [threading.Thread(target=self.client.get_timeoffs,
+                                       args=(day, day, BACKGROUND))
+                      for day in days]
+        background[0].start()
+        time.sleep(0.1) # the first is throttled, holding everyone off
+        for thread in background[1:]:
+            thread.start()
+        time.sleep(0.05)
+        leaves = self.client.get_timeoffs(NEXT_WEEK, NEXT_WEEK)
+        self.assertEqual(4, len(leaves))
+        for thread in background:
+            thread.join()
+        # the interactive request went first once the throttling lifted
+        self.assertEqual([str(TODAY), str(NEXT_WEEK)], THROTTLED_REQUESTS[:2])
+        self.assertEqual(len(days) + 2, len(THROTTLED_REQUESTS))
+
+    def test_interactive_request_not_held_behind_background_one(self):
+        THROTTLED_RESPONSES[:] = []
+        client = bhr_client.BambooHrClient(
+            TEST_API_KEY, THROTTLED_COMPANY, TEST_HOST,
+            HttpClient(limiter=RateLimiter(rate=4, burst=2, reserve=1)))
+        # leaves a token, too few for a background request
+        client.get_timeoffs(NEXT_WEEK, NEXT_WEEK)
+        background = threading.Thread(target=client.get_timeoffs,
+                                      args=(TODAY, TODAY, BACKGROUND))
+        background.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        client.get_timeoffs(TODAY, TODAY)
+        self.assertLess(time.monotonic() - started, 0.15)
+        background.join()
+        self.assertEqual([str(NEXT_WEEK), str(TODAY), str(TODAY)],
+                         THROTTLED_REQUESTS)
+
+class TestConditionalGet(unittest.TestCase):
+
+    def setUp(self):
+        CONDITIONAL_REQUESTS[:] = []
+        self.client = bhr_client.BambooHrClient(TEST_API_KEY,
+                                                CONDITIONAL_COMPANY, TEST_HOST)
+
+    def test_directory_not_modified_is_not_reparsed(self):
+        emps = self.client.get_employees_directory()
+        self.assertEqual(5, len(emps))
+        self.assertIs(emps, self.client.get_employees_directory())
+        self.assertEqual([('directory', None, 200),
+                          ('directory', DIRECTORY_ETAG, 304)],
+                         CONDITIONAL_REQUESTS)
+
+    def test_whos_out_not_modified_since(self):
+        timeoffs = self.client.get_timeoffs(TODAY, NEXT_WEEK)
+        self.assertIs(timeoffs, self.client.get_timeoffs(TODAY, NEXT_WEEK))
+        self.assertEqual([('whos_out', None, 200),
+                          ('whos_out', WHOS_OUT_LAST_MODIFIED, 304)],
+                         CONDITIONAL_REQUESTS)
+        # other days are fetched afresh
+        self.client.get_timeoffs(TOMORROW, NEXT_WEEK)
+        self.assertEqual(('whos_out', None, 200), CONDITIONAL_REQUESTS[-1])
+
+    def test_responses_are_gzipped(self):
+        self.client.get_employees_directory()
+        self.assertIn('gzip', CONDITIONAL_ACCEPT_ENCODINGS[-1])
+
+class TestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        SLOW_REQUESTS[:] = []
+        self.client = bhr_client.BambooHrClient(TEST_API_KEY, SLOW_COMPANY,
+                                                TEST_HOST)
+
+    def fire(self, n, fn):
+        results = [None] * n
+        def call(i):
+            try:
+                results[i] = fn()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_requests_share_one_upstream_call(self):
+        results = self.fire(5, lambda: self.client.get_timeoffs(TODAY, TODAY))
+        self.assertEqual(['whos_out'], SLOW_REQUESTS)
+        self.assertEqual(4, len(results[0]))
+        for result in results[1:]:
+            self.assertIs(results[0], result)
+        # once finished, the next call goes upstream again
+        self.client.get_timeoffs(TODAY, TODAY)
+        self.assertEqual(['whos_out', 'whos_out'], SLOW_REQUESTS)
+
+    def test_different_parameters_are_not_coalesced(self):
+        self.fire(2, lambda: self.client.get_timeoffs(TODAY, TODAY))
+        self.fire(1, lambda: self.client.get_timeoffs(TODAY, TOMORROW))
+        self.assertEqual(['whos_out', 'whos_out'], SLOW_REQUESTS)
+
+    def test_errors_are_shared(self):
+        client = bhr_client.BambooHrClient(TEST_API_KEY, SLOW_COMPANY,
+                                           TEST_HOST, HttpClient(max_retries=0))
+        SLOW_FAILURES[:] = [503]
+        results = self.fire(3, lambda: client.get_timeoffs(TODAY, TODAY))
+        self.assertEqual(['whos_out'], SLOW_REQUESTS)
+        for result in results:
+            self.assertIsInstance(result, requests.exceptions.HTTPError)
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def chunked(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_iter_json_array(self):
+        text = ' [{"id": 12345, "name": "Zo\\u00eb \\"Z\\" Ball"}, 67890,\n'\
+               ' [1, 2.5e3], null, true, "x,]"] '
+        expected = json.loads(text)
+        for size in (1, 2, 3, 7, len(text)):
+            self.assertEqual(expected, list(bhr_client.iter_json_array(
+                self.chunked(text, size))))
+
+    def test_iter_json_array_with_key(self):
+        text = '{"fields": [{"id": "x"}], "other": {"a": [1]}, '\
+               '"employees": [{"id": "1"}, {"id": "2"}], "after": 1}'
+        for size in (1, 5, len(text)):
+            self.assertEqual([{'id': '1'}, {'id': '2'}],
+                             list(bhr_client.iter_json_array(
+                                 self.chunked(text, size), 'employees')))
+
+    def test_iter_json_array_empty(self):
+        self.assertEqual([], list(bhr_client.iter_json_array(['[', ' ]'])))
+        self.assertEqual([], list(bhr_client.iter_json_array(
+            ['{"employees"', ':[]}'], 'employees')))
+
+    def test_iter_json_array_truncated(self):
+        with self.assertRaises(ValueError):
+            list(bhr_client.iter_json_array(['[{"id": 1}, {"id"']))
+
+FLAKY_RESPONSES = []
+
+@route("/flaky")
+def flaky_request_handler():
+    if FLAKY_RESPONSES:
+        status = FLAKY_RESPONSES.pop(0)
+        if isinstance(status, tuple): # (429, Retry-After)
+            status, retry_after = status
+            bottle.response.set_header('Retry-After', retry_after)
+        bottle.response.status = status
+        return 'error'
+    return 'ok'
+
+@route("/api/gateway.php/" + TEST_COMPANY + "/v1/employees/directory")
+def directory_request_handler():
+    return """{
+    "fields": [
+    {"id":"displayName","type":"text","name":"Display name"},
+    {"id":"firstName","type":"text","name":"First name"},
+    {"id":"lastName","type":"text","name":"Last name"},
+    {"id":"nickname","type":"text","name":"Nick name"}],
+    "employees": [
+    {"id": "50446",
+     "displayName": "Sarah Surely",
+     "firstName": "Sarah",
+     "lastName": "Surely",
+     "nickname": null},
+    {"id": "001",
+     "displayName": "Firstname Surname",
+     "firstName": "First",
+     "lastName": "Last",
+     "nickname": "firstlast"},
+    {"id": "60401",
+     "displayName": "Charlie Brown",
+     "firstName": "Charlie",
+     "lastName": "Brown",
+     "nickname": null},
+    {"id": "002",
+     "displayName": "Barry Smith",
+     "firstName": "Barry",
+     "lastName": "Smith",
+     "nickname": null},
+    {"id": "003",
+     "displayName": "Mary-Jane Spiderman",
+     "firstName": "Mary-Jane",
+     "lastName": "Spiderman",
+     "nickname": "M-J"}
+    ]}"""
+
+@route("/api/gateway.php/" + TEST_COMPANY + "/v1/time_off/whos_out/")
+def whosout_request_handler():
+    return """[
+    {"id":121, "type":"timeoff", "employeeId":50446, "name": "Sarah Surely",
+     "start": "%(today)s", "end": "%(today)s"},
+    {"id":122, "type":"timeoff", "employeeId":50446, "name": "Sarah Surely",
+     "start": "%(next_week)s", "end": "%(next_week)s"},
+    {"id":940, "type":"timeoff", "employeeId":60401, "name": "Charlie Brown",
+     "start": "%(today)s", "end": "%(next_week)s"},
+    {"id":941, "type":"timeoff", "employeeId":2, "name": "Barry Smith",
+     "start": "%(tomorrow)s", "end": "%(tomorrow)s"},
+    {"id":1, "type":"holiday", "name": "Bank holiday",
+     "start": "%(tomorrow)s", "end": "%(tomorrow)s"}]""" % {
+         'today': TODAY, 'tomorrow': TOMORROW, 'next_week': NEXT_WEEK}
+
+SLOW_COMPANY = 'slow-industries'
+SLOW_RESPONSE_DELAY = 0.3 # seconds
+SLOW_REQUESTS = [] # endpoints requested, in order
+SLOW_FAILURES = [] # statuses to respond with before succeeding
+
+@route("/api/gateway.php/" + SLOW_COMPANY + "/v1/employees/directory")
+def slow_directory_request_handler():
+    SLOW_REQUESTS.append('directory')
+    gevent.sleep(SLOW_RESPONSE_DELAY)
+    return directory_request_handler()
+
+@route("/api/gateway.php/" + SLOW_COMPANY + "/v1/time_off/whos_out/")
+def slow_whosout_request_handler():
+    SLOW_REQUESTS.append('whos_out')
+    gevent.sleep(SLOW_RESPONSE_DELAY)
+    if SLOW_FAILURES:
+        bottle.response.status = SLOW_FAILURES.pop(0)
+        return 'error'
+    return whosout_request_handler()
+
+THROTTLED_COMPANY = 'throttled-industries'
+THROTTLED_REQUESTS = [] # start dates of whos_out requests, in order
+THROTTLED_RESPONSES = [] # Retry-Afters of 429s to respond with first
+
+@route("/api/gateway.php/" + THROTTLED_COMPANY + "/v1/time_off/whos_out/")
+def throttled_whosout_request_handler():
+    THROTTLED_REQUESTS.append(bottle.request.query.get('start'))
+    if THROTTLED_RESPONSES:
+        bottle.response.status = 429
+        bottle.response.set_header('Retry-After', THROTTLED_RESPONSES.pop(0))
+        return 'slow down'
+    return whosout_request_handler()
+
+CONDITIONAL_COMPANY = 'conditional-industries'
+DIRECTORY_ETAG = '"directory-v1"'
+WHOS_OUT_LAST_MODIFIED = 'Wed, 21 Oct 2015 07:28:00 GMT'
+CONDITIONAL_REQUESTS = [] # (endpoint, validator sent, status returned)
+CONDITIONAL_ACCEPT_ENCODINGS = []
+
+def conditional_response(endpoint, header, validator, body):
+    '''A gzipped BODY with VALIDATOR in HEADER, or 304 if the request's
+    conditional header already has VALIDATOR'''
+    request_header = 'If-None-Match' if header == 'ETag' \
+                     else 'If-Modified-Since'
+    sent = bottle.request.headers.get(request_header)
+    CONDITIONAL_ACCEPT_ENCODINGS.append(
+        bottle.request.headers.get('Accept-Encoding', ''))
+    bottle.response.set_header(header, validator)
+    if sent == validator:
+        CONDITIONAL_REQUESTS.append((endpoint, sent, 304))
+        bottle.response.status = 304
+        return ''
+    CONDITIONAL_REQUESTS.append((endpoint, sent, 200))
+    bottle.response.set_header('Content-Encoding', 'gzip')
+    bottle.response.content_type = 'application/json'
+    return gzip.compress(body.encode('utf-8'))
+
+@route("/api/gateway.php/" + CONDITIONAL_COMPANY + "/v1/employees/directory")
+def conditional_directory_request_handler():
+    return conditional_response('directory', 'ETag', DIRECTORY_ETAG,
+                                directory_request_handler())
+
+@route("/api/gateway.php/" + CONDITIONAL_COMPANY + "/v1/time_off/whos_out/")
+def conditional_whosout_request_handler():
+    validator = WHOS_OUT_LAST_MODIFIED
+    if bottle.request.query.get('start') != str(TODAY):
+        validator = 'Thu, 22 Oct 2015 07:28:00 GMT'
+    return conditional_response('whos_out', 'Last-Modified', validator,
+                                whosout_request_handler())
+
+def run_fn():
+    return bottle.run(host='localhost', port=8080, debug=True,
+                      server='gevent')
+
+if __name__ == '__main__':
+    GREENLET = gevent.spawn(run_fn)
+    unittest.main()
+    GREENLET.kill()
@@ -0,0 +1,57 @@
+"""Simple wrapper for HipChat API calls"""
+import asyncio
+import json
+from bhr_client import HttpClient
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+
+PAGE_SIZE = 1000 # the most users HipChat will return in one page
+CONCURRENT_PAGES = 4
+
+class HipChatClient(object):
+    """Simple wrapper for getting the list of all HipChat users"""
+
+    def __init__(self, host, token, http=None, page_size=PAGE_SIZE,
+                 concurrent_pages=CONCURRENT_PAGES):
+        self._url = host + "/v2/user"
+        self._token = token
+        self._http = http or HttpClient()
+        self._page_size = page_size
+        self._concurrent_pages = concurrent_pages
+
+    def _get_page(self, start_index):
+        response = self._http.get(self._url,
+                                  params={'auth_token': self._token,
+                                          'start-index': start_index,
+                                          'max-results': self._page_size})
+        return json.loads(response.text)['items']
+
+    @METRICS.timed('hipchat_users')
+    def get_users(self):
+        """Gets a list of all users. After the first page, pages are fetched
+        several at a time until one comes back short"""
+        users = self._get_page(0)
+        if len(users) < self._page_size:
+            return users
+        start = self._page_size
+        with ThreadPoolExecutor(self._concurrent_pages) as executor:
+            while True:
+                starts = range(start,
+                               start + self._page_size * self._concurrent_pages,
+                               self._page_size)
+                for page in executor.map(self._get_page, starts):
+                    users.extend(page)
+                    if len(page) < self._page_size:
+                        return users
+                start = starts[-1] + self._page_size
+
+class AsyncHipChatClient(object):
+    """asyncio interface to a HipChatClient, running requests in the event
+    loop's default executor"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def get_users(self):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.client.get_users)
@@ -0,0 +1,58 @@
+from gevent import monkey
+monkey.patch_all()
+import bottle
+import gevent
+import json
+import unittest
+
+from bottle import request, route
+from hipchat_client import HipChatClient
+
+TEST_HOST = 'http://localhost:8080'
+TEST_TOKEN = 'testToken'
+NUMBER_OF_USERS = 23
+
+class TestHipChatClient(unittest.TestCase):
+
+    def setUp(self):
+        REQUESTED_PAGES[:] = []
+
+    def test_get_users_fetches_all_pages(self):
+        client = HipChatClient(TEST_HOST, TEST_TOKEN, page_size=5,
+                               concurrent_pages=2)
+        users = client.get_users()
+        self.assertEqual(['User {}'.format(i) for i in range(NUMBER_OF_USERS)],
+                         [user['name'] for user in users])
+        self.assertEqual([0, 5, 10, 15, 20], sorted(REQUESTED_PAGES))
+
+    def test_get_users_single_page(self):
+        client = HipChatClient(TEST_HOST, TEST_TOKEN, page_size=100)
+        self.assertEqual(NUMBER_OF_USERS, len(client.get_users()))
+        self.assertEqual([0], REQUESTED_PAGES)
+
+    def test_get_users_exact_multiple_of_page_size(self):
+        client = HipChatClient(TEST_HOST, TEST_TOKEN, page_size=23,
+                               concurrent_pages=3)
+        self.assertEqual(NUMBER_OF_USERS, len(client.get_users()))
+        self.assertEqual([0, 23, 46, 69], sorted(REQUESTED_PAGES))
+
+REQUESTED_PAGES = []
+
+@route("/v2/user")
+def hipchat_request_handler():
+    assert request.query['auth_token'] == TEST_TOKEN
+    start = int(request.query['start-index'])
+    end = min(start + int(request.query['max-results']), NUMBER_OF_USERS)
+    REQUESTED_PAGES.append(start)
+    return json.dumps({'items': [
+        {'id': i, 'mention_name': 'User{}'.format(i), 'name': 'User {}'.format(i)}
+        for i in range(start, end)]})
+
+def run_fn():
+    return bottle.run(host='localhost', port=8080, debug=True,
+                      server='gevent')
+
+if __name__ == '__main__':
+    GREENLET = gevent.spawn(run_fn)
+    unittest.main()
+    GREENLET.kill()
@@ -1,23 +1,70 @@
 import configparser
-import imp
-import json
+import hashlib
+import importlib.util
 import os
 import re
 import requests
-import string
+import sys
+import threading
 
 from collections import namedtuple
+from datetime import datetime, time, timezone
 from errbot import BotPlugin, botcmd, re_botcmd
 from os.path import join, realpath
-bhr_client_source = join(realpath(os.path.dirname(__file__)), './bhr_client.py')
-bhr_client = imp.load_source('bhr_client', bhr_client_source)
+from zoneinfo import ZoneInfo
 
-whosout_source = join(realpath(os.path.dirname(__file__)), './whosout.py')
-whosout = imp.load_source('whosout', whosout_source)
+PLUGIN_DIR = realpath(os.path.dirname(__file__))
 
-WHERES_X_PATTERN = r"^where('?s| is) (@?[^?]+?)( today)?(\?|$)"
-IS_X_IN_PATTERN = r"""^is (@?.*) (in|out|here|away|at work|on holiday|on
- vacation|on leave)( today)?(\?)?$"""
+# the plugin's own modules, registered as SIBLING_PREFIX + name so they
+# can't clash with other plugins' modules of the same name
+SIBLINGS = ('metrics', 'bhr_client', 'hipchat_client', 'snapshot', 'whosout',
+            'webhooks')
+SIBLING_PREFIX = 'holidaybot_'
+
+def load_sibling(name):
+    """Executes NAME.py from the plugin directory, which errbot doesn't put
+    on the path, registering it as holidaybot_NAME. The siblings it imports
+    by their plain names are only visible as such while it runs. Like
+    imp.load_source, a reloaded plugin gets fresh modules"""
+    spec = importlib.util.spec_from_file_location(
+        SIBLING_PREFIX + name, join(PLUGIN_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    hidden = {sibling: sys.modules.get(sibling) for sibling in SIBLINGS}
+    for sibling in SIBLINGS:
+        loaded = sys.modules.get(SIBLING_PREFIX + sibling)
+        if loaded is not None:
+            sys.modules[sibling] = loaded
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        for sibling, other in hidden.items():
+            if other is None:
+                sys.modules.pop(sibling, None)
+            else:
+                sys.modules[sibling] = other
+    return module
+
+# loaded first so every module records to the same registry
+metrics = load_sibling('metrics')
+METRICS = metrics.METRICS
+bhr_client = load_sibling('bhr_client')
+hipchat_client = load_sibling('hipchat_client')
+snapshot = load_sibling('snapshot')
+whosout = load_sibling('whosout')
+# webhooks is only loaded if a Webhooks section is configured
+
+WHEN_PATTERN = r"(?P<when> today| tomorrow| this week| next week| on [\w/-]+)?"
+WHERES_X_PATTERN = r"^where('?s| is| are) (@?[^?]+?)" + WHEN_PATTERN + r"(\?|$)"
+IS_X_IN_PATTERN = r"""^(?:is|are) (@?.*) (in|out|here|away|at work|on holiday|on
+ vacation|on leave)""" + WHEN_PATTERN + r"(\?)?$"
+WHOS_OUT_PATTERN = r"^who('?s| is)[ ]?(out|away|around|on leave|on vaction|on holiday)" + WHEN_PATTERN + r"(\?)?$"
+WHOS_OUT_IN_PATTERN = r"^who('?s| is)[ ]?(out|away|on leave|on vacation|on holiday) in (?P<team>.+?)" + WHEN_PATTERN + r"(\?)?$"
+AT_MENTION_PATTERN = r"(?u)@([\w]+)([^\w]|$)"
+# questions answered by wheres_x and is_x_in rather than by an @mention
+QUESTION_RES = [re.compile(IS_X_IN_PATTERN), re.compile(WHERES_X_PATTERN)]
+# between the names in "is Alice, Bob and Carol in?"
+NAME_SEPARATOR_RE = re.compile(r"\s*(?:,|&|\band\b)\s*", re.IGNORECASE)
 
 BAMBOOHR_APIKEY_KEY = 'BAMBOOHR_APIKEY'
 BAMBOOHR_COMPANY_KEY = 'BAMBOOHR_COMPANY'
@@ -26,75 +73,216 @@ CONFIGURATION_TEMPLATE = {BAMBOOHR_APIKEY_KEY: 'changeme',
                           BAMBOOHR_COMPANY_KEY: 'changeme',
                           BAMBOOHR_HOST_KEY: 'https://api.bamboohr.com'}
 
+DIRECTORY_REFRESH_INTERVAL = 60 * 60 # seconds
+MENTIONS_REFRESH_INTERVAL = 60 * 60 # seconds
+METRICS_DUMP_INTERVAL = 60 # seconds
+DIGEST_CHECK_INTERVAL = 60 # seconds
+DIGEST_STORAGE_KEY = 'digests_posted' # room -> date of the last digest posted
+# with webhooks pushing changes, polling leaves is only a fallback
+WEBHOOK_LEAVE_TTL = 30 * 60 # seconds
+
+# if set, metrics are written here every METRICS_DUMP_INTERVAL, as JSON if
+# the path ends in .json and in the Prometheus text format otherwise
+METRICS_FILE_ENV_VAR = 'HOLIDAY_BOT_METRICS_FILE'
+
+SNAPSHOT_FILENAME = 'holidaybot_snapshot.pickle'
+# statuses from BambooHR meaning the key or company is wrong, not that it is down
+REJECTED_CONFIG_STATUSES = (401, 403, 404)
+
+# characters per message if the backend doesn't set MESSAGE_SIZE_LIMIT
+DEFAULT_MESSAGE_SIZE_LIMIT = 10000
+
 NO_CREDENTIALS_RESPONSE = "Unable to check. An admin needs to configure credentials"
+UNKNOWN_WHEN_RESPONSE = "Sorry, I don't know when '{}' is"
+UNKNOWN_TEAM_RESPONSE = "Sorry, I don't know of a department, division or location called '{}'"
+NOBODY_OUT_IN_TEAM_RESPONSE = "Nobody in {} is out"
+DIGEST_HEADER = "Who's out today, {:%A %d/%m}:"
+NOBODY_OUT_RESPONSE = "Nobody's out today"
 
 BambooHRConfig = namedtuple("BambooConfig", "host company api_key")
 HipchatConfig = namedtuple("HipchatConfig", "host token")
+WebhookConfig = namedtuple("WebhookConfig", "host port secret")
+# post who's out to ROOM every day at TIME (a datetime.time) in TIMEZONE
+DigestSchedule = namedtuple("DigestSchedule", "room time timezone")
 
 class HolidayBot(BotPlugin):
     """Plugin for querying who is on leave right now"""
 
+    checker = None # WhosOutChecker, once BambooHR is configured
+    hipchat = None # HipChatClient, if HipChat credentials were provided
+    webhooks = None # WebhookReceiver, if a Webhooks section was provided
+    digests = [] # DigestSchedules, one for each Digest section provided
+    mentions = {} # lower-cased HipChat mention names to display names
+    data_as_of = None # when the snapshot being served was saved, if not live
+    # (checker, mentions, versions, lower-cased mention names of people on
+    # leave today) as of the last @mention heard
+    on_leave_mentions = (None, None, None, frozenset())
+
     def activate(self):
         super().activate()
-        config = configparser.ConfigParser()
-        print("environment var = " + os.getenv('HOLIDAY_BOT_TEST_RUN', 'False'))
+        self.hipchat = None
+        self.mentions = {}
         if os.getenv('HOLIDAY_BOT_TEST_RUN') == 'True':
             path = './test_credentials.cfg'
-            print("Test run detected - loading test credentials")
+            self.log.info("Test run detected - loading test credentials")
         else:
             path = './holidaybot_credentials.cfg'
-        if (os.path.isfile(path)):
-            with open(path) as f:
-                bamboo_config = self.parse_bamboo_credentials(f)
-                try:
-                    config = CONFIGURATION_TEMPLATE
-                    config[BAMBOOHR_APIKEY_KEY] = bamboo_config.api_key
-                    config[BAMBOOHR_COMPANY_KEY] = bamboo_config.company
-                    config[BAMBOOHR_HOST_KEY] = bamboo_config.host
-                    self.configure(config)
-                except requests.exceptions.HTTPError:
-                    print("Got an http error with given bamboo hr config")
-                    self.checker = None
-            with open(path) as f:
-                hipchat_config = self.parse_hipchat_credentials(f)
-                if hipchat_config is not None:
-                    try: 
-                        self.people = self.get_hipchat_users(
-                            hipchat_config.host,
-                            hipchat_config.token)
-                    except requests.exceptions.HTTPError:
-                        print("Got an http error with given hipchat hr config")
+        credentials = self.read_credentials(path)
+        if credentials is not None:
+            hipchat_config = self.parse_hipchat_credentials(credentials)
+            if hipchat_config is not None:
+                # HipChat users are fetched alongside BambooHR data when
+                # configured below
+                self.hipchat = hipchat_client.HipChatClient(
+                    hipchat_config.host,
+                    hipchat_config.token)
+            self.digests = self.parse_digest_settings(credentials)
+            webhook_config = self.parse_webhook_settings(credentials)
+            if webhook_config is not None:
+                self.start_webhooks(webhook_config)
+            bamboo_config = self.parse_bamboo_credentials(credentials)
+            try:
+                config = dict(CONFIGURATION_TEMPLATE)
+                config[BAMBOOHR_APIKEY_KEY] = bamboo_config.api_key
+                config[BAMBOOHR_COMPANY_KEY] = bamboo_config.company
+                config[BAMBOOHR_HOST_KEY] = bamboo_config.host
+                self.configure(config)
+            except requests.exceptions.HTTPError:
+                self.log.error("Got an http error with given bamboo hr config")
+                self.checker = None
         else:
-            print ("Could not locate credentials file at " + path)
-            self.people = {}
+            self.log.warning("Could not locate credentials file path=%s", path)
             self.checker = None
+        self.start_poller(DIRECTORY_REFRESH_INTERVAL, self.refresh_directory)
+        self.start_poller(MENTIONS_REFRESH_INTERVAL, self.refresh_mentions)
+        if len(self.digests) > 0:
+            self.start_poller(DIGEST_CHECK_INTERVAL, self.post_due_digests)
+        if os.getenv(METRICS_FILE_ENV_VAR):
+            self.start_poller(METRICS_DUMP_INTERVAL, self.dump_metrics)
+
+    def deactivate(self):
+        if self.webhooks is not None:
+            self.webhooks.stop()
+            self.webhooks = None
+        super().deactivate()
+
+    def start_webhooks(self, webhook_config):
+        """Listens for BambooHR webhooks, applying them to whichever checker
+        is current when they arrive"""
+        webhooks = load_sibling('webhooks')
+        port = webhook_config.port
+        if port is None:
+            port = webhooks.DEFAULT_PORT
+        try:
+            self.webhooks = webhooks.WebhookReceiver(
+                lambda: self.checker,
+                webhook_config.host,
+                port,
+                webhook_config.secret).start()
+        except OSError as e:
+            self.log.error("Could not listen for webhooks port=%s error=%s",
+                           port, e)
+            return
+        self.log.info("Listening for webhooks host=%s port=%s",
+                      webhook_config.host, self.webhooks.port)
+
+    def get_leave_ttl(self):
+        if self.webhooks is not None:
+            return WEBHOOK_LEAVE_TTL
+        return whosout.DEFAULT_LEAVE_TTL
+
+    def dump_metrics(self):
+        path = os.getenv(METRICS_FILE_ENV_VAR)
+        try:
+            METRICS.dump(path)
+        except OSError as e:
+            self.log.warning("Failed to dump metrics path=%s error=%s",
+                             path, e)
+
+    def refresh_directory(self):
+        """Picks up new, departed and renamed employees. While serving a
+        snapshot, because BambooHR couldn't be reached at startup, tries
+        reloading everything instead"""
+        if self.checker is None:
+            return
+        if self.data_as_of is not None:
+            self.reconcile_with_bamboohr(self.config)
+            return
+        try:
+            self.checker.refresh_directory()
+        except requests.exceptions.RequestException as e:
+            self.log.warning("Failed to refresh the employees directory "
+                             "error=%s", e)
+            return
+        self.save_snapshot()
 
-    def parse_bamboo_credentials(self, f):
+    def read_credentials(self, path):
+        """The credentials file at PATH, parsed once for all the sections
+        below, or None if there isn't one"""
+        if not os.path.isfile(path):
+            return None
         config = configparser.ConfigParser()
-        config.read_file(f)
+        with open(path) as f:
+            config.read_file(f)
+        return config
+
+    def parse_bamboo_credentials(self, config):
         host = config.get('BambooHR', 'Host')
         company = config.get('BambooHR', 'Company')
         api_key = config.get('BambooHR', 'ApiKey')
         return BambooHRConfig(host, company, api_key)
 
-    def parse_hipchat_credentials(self, f):
-        config = configparser.ConfigParser()
-        config.read_file(f)
+    def parse_hipchat_credentials(self, config):
+        """The optional HipChat section, or None if there isn't one"""
+        if not config.has_section('HipChat'):
+            return None
         host = config.get('HipChat', 'Host')
         token = config.get('HipChat', 'Token')
         return HipchatConfig(host, token)
 
-    def get_hipchat_users(self, hipchat_host, hipchat_token):
-        url = hipchat_host + "/v2/user?auth_token=" + hipchat_token
-        response = requests.get(url)
-        if response.status_code != 200:
-            response.raise_for_status()
-        return json.loads(response.text)
+    def parse_webhook_settings(self, config):
+        """The optional Webhooks section, or None if there isn't one. A port
+        of None means webhooks.DEFAULT_PORT"""
+        if not config.has_section('Webhooks'):
+            return None
+        return WebhookConfig(
+            config.get('Webhooks', 'Host', fallback='localhost'),
+            config.getint('Webhooks', 'Port', fallback=None),
+            config.get('Webhooks', 'Secret', fallback=None))
+
+    def parse_digest_settings(self, config):
+        """A DigestSchedule for each section named Digest or starting with
+        'Digest ', e.g. [Digest london]"""
+        digests = []
+        for section in config.sections():
+            if section != 'Digest' and not section.startswith('Digest '):
+                continue
+            hour, minute = config.get(section, 'Time',
+                                      fallback='09:00').split(':')
+            digests.append(DigestSchedule(
+                config.get(section, 'Room'),
+                time(int(hour), int(minute)),
+                ZoneInfo(config.get(section, 'Timezone', fallback='UTC'))))
+        return digests
+
+    def refresh_mentions(self):
+        """Rebuilds the index of HipChat mention names to display names,
+        swapping it in once complete"""
+        if self.hipchat is not None:
+            bhr_client.run_concurrently(self.refresh_mentions_async())
+
+    async def refresh_mentions_async(self):
+        try:
+            users = await hipchat_client.AsyncHipChatClient(
+                self.hipchat).get_users()
+        except requests.exceptions.RequestException as e:
+            self.log.warning("Failed to fetch HipChat users error=%s", e)
+            return
+        self.mentions = {user['mention_name'].lower(): user['name']
+                         for user in users}
 
     def get_name_from_mention(self, mention):
-        for person in self.people['items']:
-            if person['mention_name'].lower() == mention.lower():
-                return person['name']
+        return self.mentions.get(mention.lower())
 
     def get_configuration_template(self):
         return CONFIGURATION_TEMPLATE
@@ -110,41 +298,170 @@ class HolidayBot(BotPlugin):
         # Check it has been changed from default
         # if self.config == CONFIGURATION_TEMPLATE:
             # return
-        print("initialising to config: ", self.config)
+        self.log.info("Initialising checker host=%s company=%s",
+                      self.config[BAMBOOHR_HOST_KEY],
+                      self.config[BAMBOOHR_COMPANY_KEY])
         self.initialise_checker_from_config(self.config)
 
     def initialise_checker_from_config(self, config):
+        """Serves from the snapshot saved for this config, if there is one,
+        while checking in with BambooHR in the background. Otherwise fetches
+        everything from BambooHR before returning"""
+        restored = snapshot.load_snapshot(self.get_snapshot_path(),
+                                          self.get_snapshot_key(config))
+        if restored is not None:
+            self.restore_snapshot(config, *restored)
+            threading.Thread(target=self.reconcile_with_bamboohr,
+                             args=(config,), daemon=True).start()
+            return
         try:
-            self.checker = whosout.WhosOutChecker(
-                config[BAMBOOHR_APIKEY_KEY],
-                config[BAMBOOHR_COMPANY_KEY],
-                config[BAMBOOHR_HOST_KEY])
+            self.load_from_bamboohr(config)
         except requests.exceptions.HTTPError:
-            print("Got an http error with given config")
+            self.log.error("Got an http error with given config")
             self.checker = None
 
+    def load_from_bamboohr(self, config, priority=bhr_client.INTERACTIVE):
+        """Fetches the employees directory, who's out and (if configured)
+        HipChat users, all at the same time. BambooHR requests are made at
+        PRIORITY"""
+        checker = whosout.WhosOutChecker(
+            config[BAMBOOHR_APIKEY_KEY],
+            config[BAMBOOHR_COMPANY_KEY],
+            config[BAMBOOHR_HOST_KEY],
+            leave_ttl=self.get_leave_ttl(),
+            load=False)
+        loads = [checker.load_async(priority)]
+        if self.hipchat is not None:
+            loads.append(self.refresh_mentions_async())
+        bhr_client.run_concurrently(*loads)
+        self.checker = checker
+        self.data_as_of = None
+        self.save_snapshot()
+
+    def reconcile_with_bamboohr(self, config):
+        try:
+            # nobody is waiting on it, with the snapshot being served
+            self.load_from_bamboohr(config, bhr_client.BACKGROUND)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None \
+               or e.response.status_code not in REJECTED_CONFIG_STATUSES:
+                self.log.warning("Could not reach BambooHR, serving snapshot "
+                                 "data_as_of=%s error=%s", self.data_as_of, e)
+                return
+            # the key was revoked or the company is gone, so the snapshot
+            # can't be trusted any more
+            self.log.error("BambooHR rejected the config, dropping snapshot "
+                           "error=%s", e)
+            snapshot.discard_snapshot(self.get_snapshot_path())
+            self.checker = None
+            self.data_as_of = None
+        except requests.exceptions.RequestException as e:
+            self.log.warning("Could not reach BambooHR, serving snapshot "
+                             "data_as_of=%s error=%s", self.data_as_of, e)
+
+    def get_snapshot_path(self):
+        return join(self.bot_config.BOT_DATA_DIR, SNAPSHOT_FILENAME)
+
+    @staticmethod
+    def get_snapshot_key(config):
+        # a hash of the key, so a snapshot isn't served for a different key
+        apikey = hashlib.sha256(config[BAMBOOHR_APIKEY_KEY].encode('utf-8'))
+        return (config[BAMBOOHR_HOST_KEY], config[BAMBOOHR_COMPANY_KEY],
+                apikey.hexdigest())
+
+    def restore_snapshot(self, config, saved_at, data):
+        checker = whosout.WhosOutChecker(
+            config[BAMBOOHR_APIKEY_KEY],
+            config[BAMBOOHR_COMPANY_KEY],
+            config[BAMBOOHR_HOST_KEY],
+            leave_ttl=self.get_leave_ttl(),
+            load=False)
+        checker.restore_snapshot(data['checker'])
+        self.checker = checker
+        if self.hipchat is not None:
+            self.mentions = data['mentions']
+        self.data_as_of = saved_at
+
+    def save_snapshot(self):
+        if self.checker is None or self.data_as_of is not None:
+            return
+        try:
+            snapshot.save_snapshot(self.get_snapshot_path(),
+                                   self.get_snapshot_key(self.config),
+                                   {'checker': self.checker.get_snapshot(),
+                                    'mentions': self.mentions})
+        except OSError as e:
+            self.log.warning("Failed to save snapshot error=%s", e)
+
+    def add_data_as_of(self, reply):
+        """Marks replies served from a snapshot with when it was saved"""
+        if self.data_as_of is None:
+            return reply
+        return reply + "\n(data as of {:%Y-%m-%d %H:%M})".format(
+            self.data_as_of)
+
+    def post_due_digests(self, now=None):
+        """Posts who's out to every room whose digest time has passed today
+        (in its timezone) and hasn't had today's digest yet. Rendering warms
+        the reply served to "who's out?" for the rest of the day"""
+        if self.checker is None:
+            return
+        now = now or datetime.now(timezone.utc)
+        posted = self.get(DIGEST_STORAGE_KEY, {})
+        for digest in self.digests:
+            local_now = now.astimezone(digest.timezone)
+            today = local_now.date()
+            if posted.get(digest.room) == today \
+               or local_now.time() < digest.time:
+                continue
+            try:
+                with METRICS.timer('digest'):
+                    reply = self.checker.get_whos_out_reply(today, today)
+            except requests.exceptions.RequestException as e:
+                self.log.warning("Failed to build digest room=%s error=%s",
+                                 digest.room, e)
+                continue
+            text = self.add_data_as_of(
+                DIGEST_HEADER.format(today) + '\n' +
+                (reply or NOBODY_OUT_RESPONSE))
+            room = self.build_identifier(digest.room)
+            for chunk in whosout.chunk_reply(text,
+                                             self.get_message_size_limit()):
+                self.send(room, chunk)
+            posted[digest.room] = today
+            self[DIGEST_STORAGE_KEY] = posted
+
     @botcmd
+    @METRICS.timed('hello')
     def hello(self, msg, args):
         """Say hello to HolidayBot"""
-        return """Hello! Ask me \"who's out\" or \"is NAME in?\" to check up on
- your colleagues"""
+        return """Hello! Ask me \"who's out\", \"who's out in TEAM\" or \"is NAME in?\"
+ to check up on your colleagues"""
+
+    @botcmd(admin_only=True)
+    def holidaybot_stats(self, msg, args):
+        """Call counts, latencies, cache hit ratios and errors since start"""
+        return "```\n" + METRICS.format_text() + "\n```"
 
     @re_botcmd(pattern=WHERES_X_PATTERN, prefixed=False, flags=re.IGNORECASE)
+    @METRICS.timed('wheres_x')
     def wheres_x(self, msg, match):
         '''Reply to variants of "where is X?"'''
         name = match.group(2)
-        for x in self.where_is(name):
+        for x in self.where_is(name, when=match.group('when')):
             yield x
 
     @re_botcmd(pattern=IS_X_IN_PATTERN, prefixed=False, flags=re.IGNORECASE)
+    @METRICS.timed('is_x_in')
     def is_x_in(self, msg, match):
         """Reply to variants of 'is so-and-so in?'"""
         name = match.group(1)
-        for x in self.where_is(name):
+        for x in self.where_is(name, when=match.group('when')):
             yield x
 
-    def where_is(self, name, debug=False):
-        """Query if a specific person is here or on holiday"""
+    def where_is(self, name, debug=False, when=None):
+        """Query if a specific person, or each of a list of people like
+        "Alice, Bob and Carol", is here or on holiday, today or WHEN"""
         if debug:
             yield "where_is called with args: " + name
         if self.checker is None:
@@ -152,44 +469,130 @@ class HolidayBot(BotPlugin):
             if self.checker is None:
                 yield NO_CREDENTIALS_RESPONSE
                 return
-        if name.startswith('@'):
-            emp_name = self.get_name_from_mention(name.lstrip('@'))
-            if emp_name is None:
-                # no matching employee
-                yield whosout.build_whereis_reply(name, [])
-                return
+        days = whosout.parse_when(when)
+        if days is None:
+            yield UNKNOWN_WHEN_RESPONSE.format(when.strip())
+            return
+        # (name to reply about, name to look up or None if there's no
+        # matching employee)
+        lookups = []
+        for typed in split_names(name):
+            if typed.startswith('@'):
+                emp_name = self.get_name_from_mention(typed.lstrip('@'))
+                lookups.append((emp_name or typed, emp_name))
             else:
-                name = emp_name
-        where_is_results = self.checker.where_is(name)
-        yield whosout.build_whereis_reply(name, where_is_results)
+                lookups.append((typed, typed))
+        # every name is resolved against the same directory and leaves
+        found = iter(self.checker.where_are(
+            [lookup for _, lookup in lookups if lookup is not None],
+            start=days[0], end=days[1]))
+        results = [next(found) if lookup is not None
+                   else whosout.Whereabouts([], False)
+                   for _, lookup in lookups]
+        reply = whosout.build_whereare_reply(
+            [name for name, _ in lookups], results, _describe_when(when))
+        yield from whosout.chunk_reply(self.add_data_as_of(reply),
+                                       self.get_message_size_limit())
 
-    @re_botcmd(pattern=r"^who('?s| is)[ ]?(out|away|around|on leave|on vaction|on holiday)( today)?(\?)?$", prefixed=False, flags=re.IGNORECASE)
+    @re_botcmd(pattern=WHOS_OUT_PATTERN, prefixed=False, flags=re.IGNORECASE)
+    @METRICS.timed('whos_out')
     def whos_out(self, msg, match):
-        """Say who is away today"""
+        """Say who is away today, or on another day"""
+        if self.checker is None:
+            self.initialise_checker_from_config_if_possible()
+            if self.checker is None:
+                yield NO_CREDENTIALS_RESPONSE
+                return
+        days = whosout.parse_when(match.group('when'))
+        if days is None:
+            yield UNKNOWN_WHEN_RESPONSE.format(match.group('when').strip())
+            return
+        reply = self.add_data_as_of(self.checker.get_whos_out_reply(*days))
+        # split between lines ourselves, rather than have the backend split
+        # a long reply wherever it hits its limit
+        yield from whosout.chunk_reply(reply, self.get_message_size_limit())
+
+    @re_botcmd(pattern=WHOS_OUT_IN_PATTERN, prefixed=False,
+               flags=re.IGNORECASE)
+    @METRICS.timed('whos_out_in')
+    def whos_out_in(self, msg, match):
+        """Say who in a department, division or location is away today, or
+        on another day"""
         if self.checker is None:
             self.initialise_checker_from_config_if_possible()
             if self.checker is None:
-                return NO_CREDENTIALS_RESPONSE
-        return whosout.build_whosout_reply(self.checker.get_whos_out())
+                yield NO_CREDENTIALS_RESPONSE
+                return
+        when = match.group('when')
+        days = whosout.parse_when(when)
+        if days is None:
+            yield UNKNOWN_WHEN_RESPONSE.format(when.strip())
+            return
+        team = match.group('team').strip()
+        results = self.checker.whos_out_in(team, *days)
+        if results is None:
+            yield UNKNOWN_TEAM_RESPONSE.format(team)
+            return
+        reply = whosout.build_whosout_reply(results)
+        if reply == '':
+            reply = NOBODY_OUT_IN_TEAM_RESPONSE.format(team)
+            described = _describe_when(when)
+            if described is not None:
+                reply += ' ' + described
+        yield from whosout.chunk_reply(self.add_data_as_of(reply),
+                                       self.get_message_size_limit())
+
+    def get_message_size_limit(self):
+        return self.bot_config.MESSAGE_SIZE_LIMIT or DEFAULT_MESSAGE_SIZE_LIMIT
+
+    def get_on_leave_mentions(self):
+        """Lower-cased mention names of everyone on leave today, rebuilt
+        whenever the mentions, directory or leave calendar change"""
+        checker, mentions = self.checker, self.mentions
+        checker.leaves.get() # refreshes leaves once they're stale
+        versions = (checker.directory_version, checker.leaves.version)
+        cached_checker, cached_mentions, cached_versions, on_leave_mentions = \
+            self.on_leave_mentions
+        if cached_checker is checker and cached_mentions is mentions \
+           and cached_versions == versions:
+            METRICS.cache_hit('on_leave_mentions')
+            return on_leave_mentions
+        METRICS.cache_hit('on_leave_mentions', False)
+        names_on_leave = checker.which_on_leave(set(mentions.values()))
+        on_leave_mentions = frozenset(mention for mention, name
+                                      in mentions.items()
+                                      if name in names_on_leave)
+        self.on_leave_mentions = (checker, mentions, versions,
+                                  on_leave_mentions)
+        return on_leave_mentions
 
-    @re_botcmd(pattern=r"(?u)@([\w]+)([^\w]|$)",
+    @re_botcmd(pattern=AT_MENTION_PATTERN,
                matchall=True,
                prefixed=False)
+    @METRICS.timed('listen_for_at_mentions')
     def listen_for_at_mentions(self, msg, matches):
         "heard an @mention - i'll tell you if they're out"
-        if self.checker is None:
-            return
-        if re.match(IS_X_IN_PATTERN, msg.body) is not None \
-           or re.match(WHERES_X_PATTERN, msg.body) is not None:
+        if self.checker is None or not self.mentions:
+            # no mention can be resolved without the HipChat users
             return
-        reply = ''
+        # most mentions are of people at work, so check against everyone on
+        # leave before anything else
+        on_leave_mentions = self.get_on_leave_mentions()
+        mentioned = []
         for match in matches:
             mention_name = match.group(1)
-            name = self.get_name_from_mention(mention_name)
-            if name is None:
-                continue
-            all_results = self.checker.where_is(name)
-            on_leave = [(emp, leave) for (emp, leave) in all_results
+            if mention_name.lower() in on_leave_mentions:
+                mentioned.append((mention_name,
+                                  self.get_name_from_mention(mention_name)))
+        if len(mentioned) == 0:
+            return
+        if any(question.match(msg.body) for question in QUESTION_RES):
+            return
+        reply = ''
+        all_results = self.checker.where_are(
+            [name for (_, name) in mentioned], fuzzy=False)
+        for (mention_name, _), (results, _) in zip(mentioned, all_results):
+            on_leave = [(emp, leave) for (emp, leave) in results
                         if leave is not None]
             if len(on_leave) == 0:
                 continue
@@ -198,3 +601,15 @@ class HolidayBot(BotPlugin):
             return
         else:
             return reply
+
+def split_names(names):
+    '''The names in a list like "Alice, Bob and Carol", or just NAMES if
+    it's a single name'''
+    split = [name for name in NAME_SEPARATOR_RE.split(names.strip()) if name]
+    return split or [names]
+
+def _describe_when(when):
+    '''How to refer to the day(s) asked about in a reply, or None if today'''
+    if when is None or when.strip().lower() == 'today':
+        return None
+    return when.strip()
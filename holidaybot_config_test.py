@@ -9,14 +9,21 @@ import os
 import pytest
 import queue
 
-from bottle import route
+from bottle import abort, request, route
 from errbot.backends.test import testbot
 
 TEST_HOST = 'http://localhost:8080'
 TEST_COMPANY = 'reynholm-industries'
 
+TEST_APIKEY = 'testApikey'
+
+def check_apikey():
+    if request.auth is None or request.auth[0] != TEST_APIKEY:
+        abort(401, "Invalid API key")
+
 @route("/api/gateway.php/" + TEST_COMPANY + "/v1/employees/directory")
 def directory_request_handler():
+    check_apikey()
     return """{
     "fields": [
     {"id":"displayName","type":"text","name":"Display name"},
@@ -27,6 +34,7 @@ def directory_request_handler():
 
 @route("/api/gateway.php/" + TEST_COMPANY + "/v1/time_off/whos_out/")
 def whosout_request_handler():
+    check_apikey()
     return '''[]'''
 
 def run_fn():
@@ -226,6 +234,50 @@ class TestHolidayBot(object):
         check_reply(["could not find any employee named x"], testbot)
         self.stop_test_server()
 
+    def test_wrong_apikey_after_good_one(self, testbot):
+        '''A wrong key for a company with a snapshot shouldn't be served
+        the snapshot saved with the right key'''
+        self.start_test_server(run_fn)
+        testbot.push_message("""!plugin config HolidayBot {
+        'BAMBOOHR_APIKEY': '""" + TEST_APIKEY + """',
+        'BAMBOOHR_HOST': '""" + TEST_HOST + """',
+        'BAMBOOHR_COMPANY': '""" + TEST_COMPANY + """'}""")
+        check_reply("Plugin configuration done", testbot)
+        testbot.push_message("Is Julie in?")
+        check_reply(["could not find", "Julie"], testbot)
+
+        testbot.push_message("""!plugin config HolidayBot {
+        'BAMBOOHR_APIKEY': 'wrongApikey',
+        'BAMBOOHR_HOST': '""" + TEST_HOST + """',
+        'BAMBOOHR_COMPANY': '""" + TEST_COMPANY + """'}""")
+        check_reply("Plugin configuration done", testbot)
+        testbot.push_message("Is Julie in?")
+        check_reply(["Unable to check", "An admin needs to configure credentials"], testbot)
+        self.stop_test_server()
+
+    def test_revoked_apikey_drops_snapshot(self, testbot):
+        '''If BambooHR rejects the key a snapshot was saved with, the
+        snapshot should stop being served'''
+        self.start_test_server(run_fn)
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        config = {holidaybot.BAMBOOHR_APIKEY_KEY: 'revokedApikey',
+                  holidaybot.BAMBOOHR_HOST_KEY: TEST_HOST,
+                  holidaybot.BAMBOOHR_COMPANY_KEY: TEST_COMPANY}
+        holidaybot.snapshot.save_snapshot(
+            plugin.get_snapshot_path(), plugin.get_snapshot_key(config),
+            {'checker': {'emps': {}, 'namesets': {}, 'teams': {},
+                         'leaves': None},
+             'mentions': {}})
+        plugin.configure(config)
+        # wait for the reconcile with BambooHR
+        for _ in range(50):
+            if plugin.checker is None:
+                break
+            gevent.sleep(0.1)
+        testbot.push_message("Is Julie in?")
+        check_reply(["Unable to check", "An admin needs to configure credentials"], testbot)
+        self.stop_test_server()
+
 
 def check_reply(expected, testbot):
     try:
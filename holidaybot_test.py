@@ -6,9 +6,10 @@ import holidaybot
 import logging
 import pytest
 import queue
+import re
 
 from bottle import route
-from datetime import date, timedelta
+from datetime import date, datetime, time, timedelta
 from errbot.backends.test import testbot
 
 TEST_HOST = 'http://localhost:8080'
@@ -17,6 +18,7 @@ TEST_COMPANY = 'reynholm-industries'
 
 TODAY = date.today().strftime('%Y-%m-%d')
 TOMORROW = (date.today() + timedelta(1)).strftime('%Y-%m-%d')
+NEXT_WEEK = (date.today() + timedelta(7)).strftime('%Y-%m-%d')
 
 ## TODO Set up custom reponses within each test so that the
 ## expected behaviour under test is more obvious.
@@ -47,38 +49,52 @@ def directory_request_handler():
     {"id":"displayName","type":"text","name":"Display name"},
     {"id":"firstName","type":"text","name":"First name"},
     {"id":"lastName","type":"text","name":"Last name"},
-    {"id":"nickname","type":"text","name":"Nick name"}],
+    {"id":"nickname","type":"text","name":"Nick name"},
+    {"id":"department","type":"list","name":"Department"},
+    {"id":"location","type":"list","name":"Location"}],
     "employees": [
     {"id": "50446",
      "displayName": "Sarah Skiver",
      "firstName": "Sarah",
      "lastName": "Skiver",
-     "nickname": null},
+     "nickname": null,
+     "department": "Engineering",
+     "location": "London"},
     {"id": "3001",
      "displayName": "Hugo Boss",
      "firstName": "Hugo",
      "lastName": "Boss",
-     "nickname": "hugs"},
+     "nickname": "hugs",
+     "department": "Sales",
+     "location": "London"},
     {"id": "60401",
      "displayName": "Charlie Brown",
      "firstName": "Charlie",
      "lastName": "Brown",
-     "nickname": null},
+     "nickname": null,
+     "department": "Engineering",
+     "location": "San Francisco"},
     {"id": "60402",
      "displayName": "Willem Samuel",
      "firstName": "Willem",
      "lastName": "Samuel",
-     "nickname": "Will"},
+     "nickname": "Will",
+     "department": "Sales",
+     "location": "San Francisco"},
     {"id": "1473",
      "displayName": "Holiday Harry",
      "firstName": "Holiday",
      "lastName": "Harry",
-     "nickname": null},
+     "nickname": null,
+     "department": "Engineering",
+     "location": "London"},
     {"id": "39223",
      "displayName": "Zoe Ball",
      "firstName": "Zoe",
      "lastName": "Ball",
-     "nickname": null}
+     "nickname": null,
+     "department": "Research",
+     "location": "London"}
     ]}"""
 
 @route("/api/gateway.php/" + TEST_COMPANY + "/v1/time_off/whos_out/")
@@ -87,7 +103,9 @@ def whosout_request_handler():
     {"id":121, "type":"timeoff", "employeeId":50446, "name": "Sarah Skiver",
      "start": "''' + TODAY + '''", "end": "''' + TOMORROW + '''"},
     {"id":940, "type":"timeoff", "employeeId":60401, "name": "Charlie Brown",
-     "start": "2015-05-21", "end": "2015-05-28"},
+     "start": "''' + TODAY + '''", "end": "''' + NEXT_WEEK + '''"},
+    {"id":941, "type":"timeoff", "employeeId":3001, "name": "Hugo Boss",
+     "start": "''' + TOMORROW + '''", "end": "''' + TOMORROW + '''"},
     {"id":131, "type":"timeoff", "employeeId":1473, "name": "Holiday Harry",
      "start": "''' + TODAY + '''", "end": "''' + TOMORROW + '''"},
     {"id":384, "type":"timeoff", "employeeId":39223, "name": "Zoe Ball",
@@ -117,6 +135,121 @@ class TestHolidayBot(object):
         assert 'Charlie Brown:' in msg
         print(msg)
 
+    def test_whos_out_tomorrow(self, testbot):
+        testbot.push_message("who's out tomorrow?")
+        msg = testbot.pop_message(0.2)
+        assert 'Hugo Boss (hugs):' in msg
+        assert 'Sarah Skiver:' in msg
+        assert 'Willem Samuel' not in msg
+
+    def test_whos_out_split_between_lines(self, testbot):
+        bot_config = testbot.bot.bot_config
+        limit = bot_config.MESSAGE_SIZE_LIMIT
+        bot_config.MESSAGE_SIZE_LIMIT = 60
+        try:
+            testbot.push_message("who's out?")
+            messages = [testbot.pop_message(0.2) for _ in range(2)]
+        finally:
+            bot_config.MESSAGE_SIZE_LIMIT = limit
+        assert messages[0].startswith('Charlie Brown:')
+        assert 'Holiday Harry:' in messages[0]
+        assert messages[1].startswith('Sarah Skiver:')
+        assert 'Zoe Ball' in messages[1]
+        for message in messages:
+            assert len(message) <= 60
+        check_no_further_reply(messages[1], testbot)
+
+    def test_whos_out_in_team(self, testbot):
+        testbot.push_message("who's out in engineering?")
+        msg = testbot.pop_message(0.2)
+        assert 'Sarah Skiver:' in msg
+        assert 'Charlie Brown:' in msg
+        assert 'Zoe Ball' not in msg
+        testbot.push_message("who's out in London tomorrow?")
+        msg = testbot.pop_message(0.2)
+        assert 'Hugo Boss (hugs):' in msg
+        assert 'Charlie Brown' not in msg
+
+    def test_whos_out_in_team_nobody_or_unknown(self, testbot):
+        testbot.push_message("who is away in sales?")
+        check_reply("Nobody in sales is out", testbot)
+        testbot.push_message("who's out in Narnia next week?")
+        check_reply("Sorry, I don't know of a department, division or "
+                    "location called 'Narnia'", testbot)
+
+    def test_whos_out_unknown_day(self, testbot):
+        testbot.push_message("who's out on blursday?")
+        check_reply("Sorry, I don't know when 'on blursday' is", testbot)
+
+    def test_is_x_in_tomorrow(self, testbot):
+        testbot.push_message("is Hugo in tomorrow?")
+        check_reply('Hugo Boss (hugs) is on leave tomorrow, from', testbot)
+        testbot.push_message("is @WillSam in next week?")
+        check_reply('Willem Samuel (Will) is not on leave next week', testbot)
+        testbot.push_message("where is Hugo today?")
+        check_reply('Hugo Boss (hugs) is not on leave at the moment', testbot)
+
+    def test_serves_snapshot_when_bamboohr_unavailable(self, testbot):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        config = {holidaybot.BAMBOOHR_APIKEY_KEY: 'testApikey',
+                  holidaybot.BAMBOOHR_HOST_KEY: TEST_HOST,
+                  holidaybot.BAMBOOHR_COMPANY_KEY: 'not-served'}
+        holidaybot.snapshot.save_snapshot(
+            plugin.get_snapshot_path(),
+            plugin.get_snapshot_key(config),
+            {'checker': plugin.checker.get_snapshot(),
+             'mentions': plugin.mentions})
+        plugin.configure(config)
+        testbot.push_message("is @SarahSkiver in?")
+        check_reply(['Sarah Skiver is currently on leave', '(data as of'],
+                    testbot)
+
+    def test_reconciles_once_bamboohr_is_back(self, testbot, monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        config = dict(plugin.config)
+        path = plugin.get_snapshot_path()
+        key = plugin.get_snapshot_key(config)
+        holidaybot.snapshot.save_snapshot(
+            path, key, {'checker': plugin.checker.get_snapshot(),
+                        'mentions': plugin.mentions})
+        saved_at, _ = holidaybot.snapshot.load_snapshot(path, key)
+        load_from_bamboohr = plugin.load_from_bamboohr
+        def unreachable(*args):
+            raise holidaybot.requests.exceptions.ConnectionError("down")
+        monkeypatch.setattr(plugin, 'load_from_bamboohr', unreachable)
+        plugin.configure(config)
+        gevent.sleep(0.1) # let the reconcile at startup fail
+        assert plugin.data_as_of == saved_at
+        plugin.refresh_directory()
+        assert plugin.data_as_of == saved_at
+
+        monkeypatch.setattr(plugin, 'load_from_bamboohr', load_from_bamboohr)
+        plugin.refresh_directory()
+        assert plugin.data_as_of is None
+        testbot.push_message("is @SarahSkiver in?")
+        msg = testbot.pop_message(0.2)
+        assert 'Sarah Skiver is currently on leave' in msg
+        assert 'data as of' not in msg
+        assert holidaybot.snapshot.load_snapshot(path, key)[0] > saved_at
+
+    def test_are_several_in(self, testbot):
+        testbot.push_message("is Hugo, @SarahSkiver and Frieda in?")
+        check_reply(['Hugo Boss (hugs) is not on leave',
+                     'Sarah Skiver is currently on leave',
+                     'I could not find any employee named Frieda'], testbot)
+        testbot.push_message("are Hugo & Charlie in tomorrow?")
+        check_reply(['Hugo Boss (hugs) is on leave tomorrow, from',
+                     'Charlie Brown is on leave tomorrow, from'], testbot)
+        testbot.push_message("where are Sarah and @Nobody?")
+        check_reply(['Sarah Skiver is currently on leave',
+                     'I could not find any employee named @Nobody'], testbot)
+
+    def test_split_names(self):
+        assert ['Alice', 'Bob', 'Carol Anderson'] == \
+            holidaybot.split_names('Alice, Bob, and Carol Anderson')
+        assert ['@Al', 'Brandon'] == holidaybot.split_names('@Al & Brandon')
+        assert ['Sandy'] == holidaybot.split_names('Sandy')
+
     def test_is_x_in_when_in(self, testbot):
         testbot.push_message("is Hugo out?")
         check_reply('Hugo Boss (hugs) is not on leave', testbot)
@@ -153,6 +286,26 @@ class TestHolidayBot(object):
         testbot.push_message("hey there @Hugo")
         check_no_reply(testbot)
 
+    def test_at_mentions_of_people_at_work_skip_checker(self, testbot,
+                                                        monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        def where_are(*args, **kwargs):
+            pytest.fail("where_are called for a mention of someone at work")
+        monkeypatch.setattr(plugin.checker, 'where_are', where_are)
+        testbot.push_message("@Hugo @WillSam @NobodyKnows stand up time")
+        check_no_reply(testbot)
+
+    def test_at_mentions_without_hipchat_skip_checker(self, testbot,
+                                                      monkeypatch):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        fetches = []
+        monkeypatch.setattr(plugin, 'mentions', {})
+        monkeypatch.setattr(plugin.checker.leaves, 'get',
+                            lambda: fetches.append('leaves'))
+        testbot.push_message("@SarahSkiver stand up time")
+        check_no_reply(testbot)
+        assert fetches == []
+
     def test_multiple_at_mentions(self, testbot):
         testbot.push_message("can you hear me @Hugo and @SarahSkiver")
         check_reply('Sarah Skiver is currently on leave', testbot)
@@ -176,6 +329,48 @@ class TestHolidayBot(object):
         testbot.push_message("@Zo\xe8")
         check_reply("Zoe Ball is currently on leave", testbot)
 
+    def test_holidaybot_stats(self, testbot):
+        testbot.push_message("who's out?")
+        testbot.pop_message(0.2)
+        testbot.push_message("!holidaybot stats")
+        check_reply(['whos_out', 'bamboohr_directory', 'cache leaves'],
+                    testbot)
+
+    def test_post_due_digests(self, testbot):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        tokyo = holidaybot.ZoneInfo('Asia/Tokyo')
+        plugin.digests = [holidaybot.DigestSchedule('#general', time(9, 0),
+                                                    tokyo)]
+        morning = datetime.combine(date.today(), time(8, 59), tokyo)
+        plugin.post_due_digests(morning)
+        check_no_reply(testbot)
+        plugin.post_due_digests(morning + timedelta(minutes=1))
+        check_reply(["Who's out today", 'Sarah Skiver:', 'Charlie Brown:'],
+                    testbot)
+        # only once a day
+        plugin.post_due_digests(morning + timedelta(hours=3))
+        check_no_reply(testbot)
+        plugin.post_due_digests(morning + timedelta(days=1, minutes=1))
+        check_reply("Who's out today", testbot)
+
+    def test_digest_reply_kept_until_data_changes(self, testbot):
+        plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name('HolidayBot')
+        plugin.digests = [holidaybot.DigestSchedule('#general', time(0, 0),
+                                                    holidaybot.timezone.utc)]
+        plugin.post_due_digests()
+        check_reply("Who's out today", testbot)
+        checker = plugin.checker
+        reply = checker.get_whos_out_reply()
+        # a refresh that finds nothing changed, as when BambooHR says 304
+        timeoffs = checker.leaves.peek().timeoffs
+        checker.bamboohr_client.get_timeoffs = lambda *args: timeoffs
+        checker.leaves.refresh()
+        assert reply is checker.get_whos_out_reply()
+        match = re.match(holidaybot.WHOS_OUT_PATTERN, "who's out?",
+                         re.IGNORECASE)
+        chunks = list(plugin.whos_out(None, match))
+        assert len(chunks) == 1 and chunks[0] is reply
+
     def test_no_reply_to_gobbledigook(self, testbot):
         testbot.push_message('jklcjsklcs')
         check_no_reply(testbot)
@@ -0,0 +1,212 @@
+"""In-process instrumentation: call counts, latency histograms, error counts
+and cache hit ratios, reportable as text, JSON or Prometheus exposition"""
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+from bisect import bisect_left
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+           float('inf'))
+PROMETHEUS_PREFIX = 'holidaybot'
+
+class _Timing(object):
+    __slots__ = ('calls', 'errors', 'total', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def percentile(self, fraction):
+        '''Upper bound of the bucket holding the FRACTION'th call'''
+        rank = fraction * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+class _Timer(object):
+    '''Times a block as OPERATION, counting it as an error if it raises'''
+    __slots__ = ('_metrics', '_operation', '_started')
+
+    def __init__(self, metrics, operation):
+        self._metrics = metrics
+        self._operation = operation
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.observe(self._operation,
+                              time.perf_counter() - self._started,
+                              failed=exc_type is not None)
+
+class Metrics(object):
+    """Thread-safe registry of timings, counters and cache hits/misses"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+        self._caches = {}
+
+    def observe(self, operation, seconds, failed=False):
+        bucket = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            timing = self._timings.get(operation)
+            if timing is None:
+                timing = self._timings[operation] = _Timing()
+            timing.calls += 1
+            timing.errors += failed
+            timing.total += seconds
+            timing.buckets[bucket] += 1
+
+    def timer(self, operation):
+        '''Context manager timing its block as OPERATION'''
+        return _Timer(self, operation)
+
+    def timed(self, operation):
+        '''Decorator timing each call as OPERATION. For generator functions
+        only the time spent producing items is counted, not the time the
+        consumer spends between them'''
+        def decorator(fn):
+            if inspect.isgeneratorfunction(fn):
+                @functools.wraps(fn)
+                def timed_generator(*args, **kwargs):
+                    items = fn(*args, **kwargs)
+                    elapsed = 0.0
+                    while True:
+                        started = time.perf_counter()
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            self.observe(operation, elapsed +
+                                         time.perf_counter() - started)
+                            return
+                        except Exception:
+                            self.observe(operation, elapsed +
+                                         time.perf_counter() - started,
+                                         failed=True)
+                            raise
+                        elapsed += time.perf_counter() - started
+                        yield item
+                return timed_generator
+            @functools.wraps(fn)
+            def timed_function(*args, **kwargs):
+                with _Timer(self, operation):
+                    return fn(*args, **kwargs)
+            return timed_function
+        return decorator
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def cache_hit(self, cache, hit=True):
+        '''Records a lookup in CACHE, a hit unless HIT is False'''
+        with self._lock:
+            counts = self._caches.get(cache)
+            if counts is None:
+                counts = self._caches[cache] = [0, 0]
+            counts[0 if hit else 1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+            self._caches.clear()
+
+    def snapshot(self):
+        '''A JSON-serialisable copy of everything recorded so far'''
+        with self._lock:
+            timings = {operation: {'calls': t.calls,
+                                   'errors': t.errors,
+                                   'total_seconds': t.total,
+                                   'p50_seconds': t.percentile(0.5),
+                                   'p99_seconds': t.percentile(0.99),
+                                   'buckets': list(t.buckets)}
+                       for operation, t in self._timings.items()}
+            caches = {cache: {'hits': hits, 'misses': misses,
+                              'hit_ratio': hits / (hits + misses)}
+                      for cache, (hits, misses) in self._caches.items()}
+            return {'timings': timings,
+                    'counters': dict(self._counters),
+                    'caches': caches}
+
+    def format_text(self):
+        '''A plain-text table of the snapshot, for chat'''
+        snapshot = self.snapshot()
+        lines = ['{:<28} {:>7} {:>6} {:>9} {:>9}'.format(
+            'operation', 'calls', 'errors', 'mean ms', 'p99 ms')]
+        for operation, t in sorted(snapshot['timings'].items()):
+            lines.append('{:<28} {:>7} {:>6} {:>9.2f} {:>9}'.format(
+                operation, t['calls'], t['errors'],
+                t['total_seconds'] / t['calls'] * 1000,
+                _format_bound(t['p99_seconds'])))
+        for cache, c in sorted(snapshot['caches'].items()):
+            lines.append('cache {}: {:.0%} hits ({} of {})'.format(
+                cache, c['hit_ratio'], c['hits'], c['hits'] + c['misses']))
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append('{}: {}'.format(counter, value))
+        return '\n'.join(lines)
+
+    def format_prometheus(self):
+        '''The snapshot in the Prometheus text exposition format'''
+        snapshot = self.snapshot()
+        p = PROMETHEUS_PREFIX
+        lines = ['# TYPE {}_latency_seconds histogram'.format(p)]
+        for operation, t in sorted(snapshot['timings'].items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, t['buckets']):
+                cumulative += count
+                lines.append('{}_latency_seconds_bucket{{operation="{}",le="{}"}} {}'
+                             .format(p, operation,
+                                     '+Inf' if bound == float('inf') else bound,
+                                     cumulative))
+            lines.append('{}_latency_seconds_sum{{operation="{}"}} {}'.format(
+                p, operation, t['total_seconds']))
+            lines.append('{}_latency_seconds_count{{operation="{}"}} {}'.format(
+                p, operation, t['calls']))
+        lines.append('# TYPE {}_errors_total counter'.format(p))
+        for operation, t in sorted(snapshot['timings'].items()):
+            lines.append('{}_errors_total{{operation="{}"}} {}'.format(
+                p, operation, t['errors']))
+        lines.append('# TYPE {}_cache_lookups_total counter'.format(p))
+        for cache, c in sorted(snapshot['caches'].items()):
+            for result, key in (('hit', 'hits'), ('miss', 'misses')):
+                lines.append('{}_cache_lookups_total{{cache="{}",result="{}"}} {}'
+                             .format(p, cache, result, c[key]))
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(p, counter))
+            lines.append('{}_{}_total {}'.format(p, counter, value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        '''Writes the snapshot to PATH, as JSON if it ends in .json and in
+        the Prometheus text format otherwise. The file is replaced atomically
+        so scrapers never see a partial one'''
+        if path.endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        else:
+            text = self.format_prometheus()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+def _format_bound(seconds):
+    if seconds == float('inf'):
+        return '>{:g}'.format(BUCKETS[-2] * 1000)
+    return '<{:g}'.format(seconds * 1000)
+
+# the registry everything in the bot records to
+METRICS = Metrics()
@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import unittest
+
+from metrics import BUCKETS, Metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_timed_counts_calls_and_errors(self):
+        @self.metrics.timed('lookup')
+        def lookup(name):
+            if name is None:
+                raise ValueError
+            return name.upper()
+        self.assertEqual('HUGO', lookup('hugo'))
+        self.assertRaises(ValueError, lookup, None)
+        timing = self.metrics.snapshot()['timings']['lookup']
+        self.assertEqual(2, timing['calls'])
+        self.assertEqual(1, timing['errors'])
+        self.assertEqual(2, sum(timing['buckets']))
+
+    def test_timed_generator_counts_once_per_call(self):
+        @self.metrics.timed('replies')
+        def replies():
+            yield 'one'
+            yield 'two'
+        self.assertEqual(['one', 'two'], list(replies()))
+        self.assertEqual(1, self.metrics.snapshot()['timings']['replies']['calls'])
+
+    def test_observe_buckets(self):
+        self.metrics.observe('op', 0.0002)
+        self.metrics.observe('op', 10)
+        buckets = self.metrics.snapshot()['timings']['op']['buckets']
+        self.assertEqual(1, buckets[BUCKETS.index(0.0005)])
+        self.assertEqual(1, buckets[-1])
+
+    def test_cache_hit_ratio(self):
+        for hit in (True, True, True, False):
+            self.metrics.cache_hit('leaves', hit)
+        self.assertEqual({'hits': 3, 'misses': 1, 'hit_ratio': 0.75},
+                         self.metrics.snapshot()['caches']['leaves'])
+
+    def test_format_text(self):
+        self.metrics.observe('whos_out', 0.002)
+        self.metrics.cache_hit('leaves')
+        self.metrics.incr('http_retries', 2)
+        text = self.metrics.format_text()
+        self.assertIn('whos_out', text)
+        self.assertIn('cache leaves: 100% hits (1 of 1)', text)
+        self.assertIn('http_retries: 2', text)
+
+    def test_format_prometheus(self):
+        self.metrics.observe('whos_out', 0.002)
+        self.metrics.observe('whos_out', 0.02, failed=True)
+        self.metrics.cache_hit('leaves', False)
+        text = self.metrics.format_prometheus()
+        self.assertIn('holidaybot_latency_seconds_bucket'
+                      '{operation="whos_out",le="0.005"} 1', text)
+        self.assertIn('holidaybot_latency_seconds_bucket'
+                      '{operation="whos_out",le="+Inf"} 2', text)
+        self.assertIn('holidaybot_latency_seconds_count'
+                      '{operation="whos_out"} 2', text)
+        self.assertIn('holidaybot_errors_total{operation="whos_out"} 1', text)
+        self.assertIn('holidaybot_cache_lookups_total'
+                      '{cache="leaves",result="miss"} 1', text)
+
+    def test_dump_json(self):
+        self.metrics.observe('whos_out', 0.002)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            self.metrics.dump(path)
+            with open(path) as f:
+                dumped = json.load(f)
+        self.assertEqual(1, dumped['timings']['whos_out']['calls'])
+
+if __name__ == '__main__':
+    unittest.main()
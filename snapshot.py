@@ -0,0 +1,46 @@
+"""Versioned on-disk snapshot of the data needed to answer queries, so the
+bot can answer straight away after a restart, or while BambooHR is down"""
+import logging
+import os
+import pickle
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 3 # bump when the structure of the snapshot data changes
+
+def save_snapshot(path, key, data):
+    '''Writes DATA to PATH, tagged with KEY (e.g. which company it is for).
+    The file is replaced atomically so readers never see a partial one'''
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'key': key,
+                'saved_at': datetime.now(),
+                'data': data}
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+def load_snapshot(path, key):
+    '''Returns (saved_at, data) from the snapshot at PATH if there is one of
+    the current version saved for KEY, otherwise None'''
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError) as e:
+        log.warning("Ignoring unreadable snapshot path=%s error=%s", path, e)
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION \
+       or snapshot.get('key') != key:
+        return None
+    return snapshot['saved_at'], snapshot['data']
+
+def discard_snapshot(path):
+    '''Removes the snapshot at PATH, e.g. once it is known to be bad'''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
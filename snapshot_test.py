@@ -0,0 +1,58 @@
+from gevent import monkey
+monkey.patch_all()
+import gevent
+import os
+import snapshot
+import tempfile
+import unittest
+
+# the stub BambooHR server is shared with the client tests
+from bhr_client_test import TEST_API_KEY, TEST_COMPANY, TEST_HOST, run_fn
+from whosout import WhosOutChecker
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = WhosOutChecker(TEST_API_KEY, TEST_COMPANY,
+                                      TEST_HOST)
+
+    def test_snapshot_round_trip(self):
+        self.checker.get_whos_out()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'snapshot')
+            snapshot.save_snapshot(path, 'key', self.checker.get_snapshot())
+            self.assertIsNone(snapshot.load_snapshot(path, 'other key'))
+            saved_at, data = snapshot.load_snapshot(path, 'key')
+        # a company the stub server doesn't know, so nothing can be fetched
+        checker = WhosOutChecker(TEST_API_KEY, 'offline', TEST_HOST,
+                                 load=False)
+        checker.restore_snapshot(data)
+        self.assertEqual(self.checker.where_is('Sarah'),
+                         checker.where_is('Sarah'))
+        self.assertEqual(frozenset(self.checker.get_whos_out()),
+                         frozenset(checker.get_whos_out()))
+
+    def test_load_snapshot_missing_or_old(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'snapshot')
+            self.assertIsNone(snapshot.load_snapshot(path, 'key'))
+            snapshot.save_snapshot(path, 'key', {})
+            snapshot.SNAPSHOT_VERSION += 1
+            try:
+                self.assertIsNone(snapshot.load_snapshot(path, 'key'))
+            finally:
+                snapshot.SNAPSHOT_VERSION -= 1
+
+    def test_discard_snapshot(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'snapshot')
+            snapshot.save_snapshot(path, 'key', {})
+            snapshot.discard_snapshot(path)
+            self.assertIsNone(snapshot.load_snapshot(path, 'key'))
+            # discarding a snapshot that isn't there is fine
+            snapshot.discard_snapshot(path)
+
+if __name__ == '__main__':
+    GREENLET = gevent.spawn(run_fn)
+    unittest.main()
+    GREENLET.kill()
@@ -0,0 +1,166 @@
+"""Receives BambooHR employee and time off webhooks, applying them straight
+to a WhosOutChecker's directory and leave calendar"""
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from bhr_client import BambooHrClient, Leave
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8642
+EMPLOYEES_PATH = '/webhooks/employees'
+TIMEOFF_PATH = '/webhooks/timeoff'
+SIGNATURE_HEADER = 'X-BambooHR-Signature'
+TIMESTAMP_HEADER = 'X-BambooHR-Timestamp'
+MAX_PAYLOAD_SIZE = 1024 * 1024 # bytes
+# signed webhooks older (or newer) than this are rejected, so a captured one
+# can't be replayed later
+MAX_TIMESTAMP_AGE = 5 * 60 # seconds
+
+# time off request actions and statuses meaning the leave isn't happening
+REMOVED_ACTIONS = {'deleted', 'cancelled', 'canceled', 'denied', 'declined'}
+# BambooHR field names to Employee fields
+EMPLOYEE_FIELDS = [('displayName', 'display'), ('firstName', 'first'),
+                   ('lastName', 'last'), ('nickname', 'nick'),
+                   ('department', 'department'), ('division', 'division'),
+                   ('location', 'location')]
+
+def _parse_date(date_string):
+    return datetime.strptime(date_string, '%Y-%m-%d').date()
+
+def parse_employee_payload(payload, emps):
+    '''(changed, removed) from an employee webhook PAYLOAD, where changed
+    is a dictionary of new or updated Employees by id and removed a list of
+    ids. Only changed fields need be sent, the rest are taken from the
+    current Employee in EMPS'''
+    changed = {}
+    removed = []
+    for e in payload['employees']:
+        emp_id = int(e['id'])
+        if (e.get('action') or '').lower() == 'deleted':
+            removed.append(emp_id)
+            continue
+        fields = dict(e.get('fields') or {})
+        old = changed.get(emp_id) or emps.get(emp_id)
+        for field, emp_field in EMPLOYEE_FIELDS:
+            if field not in fields:
+                fields[field] = getattr(old, emp_field) if old else None
+        if fields['displayName'] is None:
+            fields['displayName'] = ' '.join(
+                name for name in (fields['firstName'], fields['lastName'])
+                if name)
+        changed[emp_id] = BambooHrClient._get_employee_from_json(fields)
+    return changed, removed
+
+def parse_timeoff_payload(payload):
+    '''(changed, removed) from a time off webhook PAYLOAD, where changed is
+    a dictionary of (employee id, Leave) pairs by request id and removed a
+    list of request ids. Only approved requests count as leave'''
+    changed = {}
+    removed = []
+    for x in payload['timeOffRequests']:
+        request_id = int(x['id'])
+        action = (x.get('action') or '').lower()
+        status = (x.get('status') or 'approved').lower()
+        if action in REMOVED_ACTIONS or status != 'approved':
+            removed.append(request_id)
+            changed.pop(request_id, None)
+        else:
+            changed[request_id] = (int(x['employeeId']),
+                                   Leave(_parse_date(x['start']),
+                                         _parse_date(x['end'])))
+    return changed, removed
+
+def sign(secret, body, timestamp):
+    '''The signature BambooHR sends with BODY at TIMESTAMP'''
+    return hmac.new(secret.encode('utf-8'), body + timestamp.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        if self.path not in (EMPLOYEES_PATH, TIMEOFF_PATH):
+            return self._respond(404)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return self._respond(400)
+        if length < 0: # rfile.read(-1) would wait for the connection to close
+            return self._respond(400)
+        if length > MAX_PAYLOAD_SIZE:
+            return self._respond(413)
+        body = self.rfile.read(length)
+        if not receiver.is_signed(body, self.headers.get(SIGNATURE_HEADER),
+                                  self.headers.get(TIMESTAMP_HEADER)):
+            return self._respond(403)
+        checker = receiver.get_checker()
+        if checker is None:
+            return self._respond(503)
+        try:
+            with METRICS.timer('webhook'):
+                payload = json.loads(body.decode('utf-8'))
+                if self.path == EMPLOYEES_PATH:
+                    checker.apply_employee_changes(
+                        *parse_employee_payload(payload, checker.emps))
+                else:
+                    checker.apply_timeoff_changes(
+                        *parse_timeoff_payload(payload))
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("Rejected webhook path=%s error=%r", self.path, e)
+            return self._respond(400)
+        self._respond(204)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug("Webhook " + format, *args)
+
+class WebhookReceiver(object):
+    """HTTP server applying webhooks to whichever WhosOutChecker
+    GET_CHECKER returns at the time. If SECRET is given, requests must be
+    signed with it"""
+
+    def __init__(self, get_checker, host='localhost', port=DEFAULT_PORT,
+                 secret=None):
+        self.get_checker = get_checker
+        self.secret = secret
+        self._server = ThreadingHTTPServer((host, port), _WebhookHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        self.port = self._server.server_port
+
+    def is_signed(self, body, signature, timestamp):
+        '''Whether BODY has a valid SIGNATURE from within MAX_TIMESTAMP_AGE,
+        if there is a secret'''
+        if self.secret is None:
+            return True
+        if signature is None or timestamp is None:
+            return False
+        try:
+            age = time.time() - int(timestamp)
+        except ValueError:
+            return False
+        if abs(age) > MAX_TIMESTAMP_AGE:
+            return False
+        return hmac.compare_digest(sign(self.secret, body, timestamp),
+                                   signature)
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
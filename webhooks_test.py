@@ -0,0 +1,198 @@
+import http.client
+import json
+import requests
+import time
+import unittest
+import webhooks
+
+from bhr_client import Employee, Leave
+from datetime import date, timedelta
+from whosout import LeaveCalendar, WhosOutChecker
+
+TODAY = date.today()
+TOMORROW = TODAY + timedelta(1)
+NEXT_WEEK = TODAY + timedelta(7)
+SECRET = 'webhook secret'
+
+SARAH = Employee('Sarah Surely', 'Sarah', 'Surely', None)
+BARRY = Employee('Barry Smith', 'Barry', 'Smith', None)
+
+def make_checker():
+    '''A checker serving fixed data, with nothing to fetch from'''
+    checker = WhosOutChecker('key', 'offline', 'http://localhost:1',
+                             load=False)
+    emps = {50446: SARAH, 2: BARRY}
+    calendar = LeaveCalendar({121: (50446, Leave(TODAY, TODAY))},
+                             TODAY, TODAY + timedelta(27))
+    checker.restore_snapshot({'emps': emps,
+                              'namesets': WhosOutChecker._build_namesets(emps),
+                              'teams': WhosOutChecker._build_teams(emps),
+                              'leaves': None})
+    checker.leaves.set(calendar)
+    return checker
+
+class TestWebhookReceiver(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = make_checker()
+        self.receiver = webhooks.WebhookReceiver(lambda: self.checker,
+                                                 '127.0.0.1', 0).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.receiver.port)
+
+    def tearDown(self):
+        self.receiver.stop()
+
+    def post(self, path, payload, **kwargs):
+        return requests.post(self.url + path, data=json.dumps(payload),
+                             **kwargs)
+
+    def test_timeoff_approved(self):
+        response = self.post(webhooks.TIMEOFF_PATH, {'timeOffRequests': [
+            {'id': '941', 'action': 'Approved', 'status': 'approved',
+             'employeeId': '2', 'start': str(TOMORROW),
+             'end': str(NEXT_WEEK)}]})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual([(BARRY, Leave(TOMORROW, NEXT_WEEK))],
+                         self.checker.where_is('Barry', start=NEXT_WEEK,
+                                               end=NEXT_WEEK))
+        self.assertEqual([(BARRY, None)], self.checker.where_is('Barry'))
+
+    def test_timeoff_cancelled(self):
+        version = self.checker.leaves.version
+        response = self.post(webhooks.TIMEOFF_PATH, {'timeOffRequests': [
+            {'id': 121, 'action': 'Cancelled', 'employeeId': 50446,
+             'start': str(TODAY), 'end': str(TODAY)}]})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual([], self.checker.get_whos_out())
+        self.assertEqual(version + 1, self.checker.leaves.version)
+
+    def test_timeoff_moved(self):
+        self.post(webhooks.TIMEOFF_PATH, {'timeOffRequests': [
+            {'id': 121, 'action': 'Updated', 'employeeId': 50446,
+             'start': str(TOMORROW), 'end': str(TOMORROW)}]})
+        self.assertEqual([], self.checker.get_whos_out())
+        self.assertEqual([(SARAH, Leave(TOMORROW, TOMORROW))],
+                         self.checker.get_whos_out(TOMORROW, TOMORROW))
+        self.assertEqual(1, len(self.checker.leaves.peek().timeoffs))
+
+    def test_employee_created_updated_and_deleted(self):
+        response = self.post(webhooks.EMPLOYEES_PATH, {'employees': [
+            {'id': '4', 'action': 'Created',
+             'fields': {'firstName': 'Polly', 'lastName': 'Shelby'}},
+            {'id': '50446', 'action': 'Updated',
+             'fields': {'lastName': 'Smith', 'displayName': 'Sarah Smith'}},
+            {'id': '2', 'action': 'Deleted'}]})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual({4: Employee('Polly Shelby', 'Polly', 'Shelby', None),
+                          50446: Employee('Sarah Smith', 'Sarah', 'Smith', None)},
+                         self.checker.emps)
+        self.assertEqual(WhosOutChecker._build_namesets(self.checker.emps),
+                         self.checker.namesets)
+        self.assertEqual([], self.checker.where_is('Barry'))
+        self.assertEqual('Sarah Smith',
+                         self.checker.where_is('Sarah Smith')[0][0].display)
+
+    def test_employee_moved_team(self):
+        self.post(webhooks.EMPLOYEES_PATH, {'employees': [
+            {'id': '50446', 'action': 'Updated',
+             'fields': {'department': 'Sales'}}]})
+        self.assertEqual(SARAH._replace(department='Sales'),
+                         self.checker.emps[50446])
+        self.assertEqual([(self.checker.emps[50446], Leave(TODAY, TODAY))],
+                         self.checker.whos_out_in('sales'))
+
+    def test_bad_payload(self):
+        response = self.post(webhooks.EMPLOYEES_PATH, {'people': []})
+        self.assertEqual(400, response.status_code)
+        response = requests.post(self.url + webhooks.TIMEOFF_PATH,
+                                 data='not json')
+        self.assertEqual(400, response.status_code)
+        # fields sent as null are treated as though they weren't sent
+        response = self.post(webhooks.TIMEOFF_PATH, {'timeOffRequests': [
+            {'id': '941', 'action': None, 'status': None,
+             'employeeId': '2', 'start': str(TOMORROW),
+             'end': str(TOMORROW)}]})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual([(BARRY, Leave(TOMORROW, TOMORROW))],
+                         self.checker.where_is('Barry', start=TOMORROW,
+                                               end=TOMORROW))
+        response = self.post(webhooks.EMPLOYEES_PATH, {'employees': [
+            {'id': '2', 'action': None, 'fields': {'nickname': 'Baz'}}]})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual('Baz', self.checker.emps[2].nick)
+
+    def test_unknown_path(self):
+        self.assertEqual(404, self.post('/elsewhere', {}).status_code)
+
+    def test_no_checker_yet(self):
+        self.checker = None
+        response = self.post(webhooks.EMPLOYEES_PATH, {'employees': []})
+        self.assertEqual(503, response.status_code)
+
+    def test_signature_required_with_secret(self):
+        self.receiver.secret = SECRET
+        payload = {'employees': [{'id': '2', 'action': 'Deleted'}]}
+        response = self.post(webhooks.EMPLOYEES_PATH, payload)
+        self.assertEqual(403, response.status_code)
+        response = self.post(webhooks.EMPLOYEES_PATH, payload, headers={
+            webhooks.SIGNATURE_HEADER: 'bad',
+            webhooks.TIMESTAMP_HEADER: '1445412480'})
+        self.assertEqual(403, response.status_code)
+        self.assertIn(2, self.checker.emps)
+        response = self.post_signed(webhooks.EMPLOYEES_PATH, payload,
+                                    str(int(time.time())))
+        self.assertEqual(204, response.status_code)
+        self.assertNotIn(2, self.checker.emps)
+
+    def test_stale_signature_rejected(self):
+        self.receiver.secret = SECRET
+        payload = {'employees': [{'id': '2', 'action': 'Deleted'}]}
+        stale = int(time.time()) - webhooks.MAX_TIMESTAMP_AGE - 60
+        response = self.post_signed(webhooks.EMPLOYEES_PATH, payload,
+                                    str(stale))
+        self.assertEqual(403, response.status_code)
+        response = self.post_signed(webhooks.EMPLOYEES_PATH, payload,
+                                    'yesterday')
+        self.assertEqual(403, response.status_code)
+        self.assertIn(2, self.checker.emps)
+
+    def post_signed(self, path, payload, timestamp):
+        body = json.dumps(payload).encode('utf-8')
+        return requests.post(self.url + path, data=body, headers={
+            webhooks.SIGNATURE_HEADER: webhooks.sign(SECRET, body, timestamp),
+            webhooks.TIMESTAMP_HEADER: timestamp})
+
+    def test_bad_content_length(self):
+        for length in ('-1', 'lots'):
+            connection = http.client.HTTPConnection('127.0.0.1',
+                                                    self.receiver.port,
+                                                    timeout=5)
+            connection.putrequest('POST', webhooks.EMPLOYEES_PATH)
+            connection.putheader('Content-Length', length)
+            connection.endheaders()
+            self.assertEqual(400, connection.getresponse().status)
+            connection.close()
+
+class TestLeaveCalendarUpdated(unittest.TestCase):
+
+    def test_updated_matches_rebuilt_calendar(self):
+        end = TODAY + timedelta(27)
+        calendar = LeaveCalendar({1: (1, Leave(TODAY, NEXT_WEEK)),
+                                  2: (2, Leave(TOMORROW, TOMORROW))},
+                                 TODAY, end)
+        updated = calendar.updated({2: (2, Leave(NEXT_WEEK, end)),
+                                    3: (3, Leave(TODAY, TODAY))}, [1])
+        expected = LeaveCalendar({2: (2, Leave(NEXT_WEEK, end)),
+                                  3: (3, Leave(TODAY, TODAY))}, TODAY, end)
+        self.assertEqual(expected.timeoffs, updated.timeoffs)
+        for offset in range(28):
+            day = TODAY + timedelta(offset)
+            self.assertEqual(expected.between(day, day),
+                             updated.between(day, day))
+        # the original is left as it was
+        self.assertEqual([(1, Leave(TODAY, NEXT_WEEK)),
+                          (2, Leave(TOMORROW, TOMORROW))],
+                         calendar.between(TOMORROW, TOMORROW))
+
+if __name__ == '__main__':
+    unittest.main()
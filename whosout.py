@@ -1,100 +1,848 @@
 #!/usr/bin/python
 import argparse
+import asyncio
 import configparser
-import re
+import csv
+import json
+import logging
+import sys
+import threading
+import time
 
-from bhr_client import BambooHrClient
-from collections import defaultdict
-from unidecode import unidecode
+from array import array
+from bhr_client import (BACKGROUND, INTERACTIVE, AsyncBambooHrClient,
+                        BambooHrClient, run_concurrently)
+from bisect import bisect_left
+from collections import Counter, defaultdict, namedtuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from itertools import chain
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LEAVE_TTL = 60 # seconds before a leave snapshot is refreshed
+DEFAULT_LEAVE_WINDOW = 28 # days of leave, from today, kept in memory
+MIN_PREFIX_LENGTH = 3 # shortest typed name to look up names starting with
+MIN_TYPO_LENGTH = 4 # shortest typed name to look up misspellings of
+MAX_TYPO_CHECKS = 50 # most names to check the edit distance of per lookup
+MAX_PREFIX_MATCHES = 50 # most names starting with a typed name per lookup
+MAX_SUGGESTIONS = 5
+MAX_CACHED_REPLIES = 32 # rendered who's out replies kept per checker
+LINE_CACHE_SIZE = 4096 # formatted reply lines kept across all replies
+TYPED_NAME_CACHE_SIZE = 4096 # normalised typed names kept across queries
+
+# Employees indexed by id, with the namesets and teams built from them.
+# Swapped as a whole so queries never see employees and indexes out of step
+Directory = namedtuple("Directory", "emps namesets teams")
+
+# where_are's result for one name: (Employee, Leave) pairs, and whether they
+# are the closest matches to a name nobody has, best first
+Whereabouts = namedtuple("Whereabouts", "matches fuzzy")
+
+POSTING_TYPECODE = 'i' # namesets hold employee ids as sorted arrays of ints
 
 def _normalise_name(name):
     if isinstance(name, str):
-        name = unidecode(name)
+        if not name.isascii():
+            # imported on first use, as most names are plain ASCII
+            from unidecode import unidecode
+            name = unidecode(name)
         name = name.replace("-", "")
     return name.lower()
 
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday']
+
+def parse_when(when, today=None):
+    '''Turns phrases like "tomorrow", "on friday", "on 21/5", "on 2015-05-21"
+    or "next week" into a (start, end) pair of dates. Returns None if WHEN
+    isn't understood'''
+    today = today or date.today()
+    when = (when or 'today').strip().lower()
+    if when.startswith('on '):
+        when = when[3:].strip()
+    if when == 'today':
+        return (today, today)
+    if when == 'tomorrow':
+        tomorrow = today + timedelta(1)
+        return (tomorrow, tomorrow)
+    if when == 'this week':
+        return (today, today + timedelta(6 - today.weekday()))
+    if when == 'next week':
+        monday = today + timedelta(7 - today.weekday())
+        return (monday, monday + timedelta(6))
+    if when in WEEKDAYS:
+        day = today + timedelta((WEEKDAYS.index(when) - today.weekday()) % 7)
+        return (day, day)
+    for date_format in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            day = datetime.strptime(when, date_format).date()
+        except ValueError:
+            continue
+        return (day, day)
+    day = _next_day_and_month(when, today)
+    return (day, day) if day else None
+
+def _next_day_and_month(when, today):
+    # strptime would parse '%d/%m' against 1900, which has no 29/2, so
+    # build the date ourselves; a leap day can be up to 8 years away
+    parts = when.split('/')
+    if len(parts) != 2 or not all(part.isdigit() for part in parts):
+        return None
+    day_of_month, month = map(int, parts)
+    for year in range(today.year, today.year + 9):
+        try:
+            day = date(year, month, day_of_month)
+        except ValueError:
+            continue
+        if day >= today:
+            return day
+    return None
+
+def _split_name(name):
+    # hyphens are already gone, so this splits on spaces alone
+    return _normalise_name(name).split(' ')
+
+def _normalise_team(team):
+    '''Department, division or location names as indexed and looked up'''
+    return ' '.join(_normalise_name(team).split())
+
+def _contains_sorted(a, x):
+    i = bisect_left(a, x)
+    return i < len(a) and a[i] == x
+
+@lru_cache(maxsize=TYPED_NAME_CACHE_SIZE)
+def _split_typed_name(typed_name):
+    '''_split_name for names typed in queries, which repeat a lot more
+    than employee names do'''
+    return tuple(_split_name(typed_name))
+
+def _intersect_sorted(a, b):
+    '''Intersection of two sorted arrays of ids, as a sorted list. Looks up
+    each id of the shorter in the longer, narrowing the search as it goes'''
+    if len(a) > len(b):
+        a, b = b, a
+    result = []
+    lo = 0
+    for x in a:
+        lo = bisect_left(b, x, lo)
+        if lo == len(b):
+            break
+        if b[lo] == x:
+            result.append(x)
+    return result
+
+class LeaveCache(object):
+    '''Caches the result of FETCH for TTL seconds. Once the TTL has passed
+    the last good snapshot keeps being served while a new one is fetched in
+    the background, with BACKGROUND_FETCH if given. A snapshot fetched on an
+    earlier day is only served if a new one can't be fetched and
+    USABLE(snapshot, today) says it still covers today'''
+
+    def __init__(self, fetch, ttl=DEFAULT_LEAVE_TTL,
+                 clock=time.monotonic, today=date.today,
+                 background_fetch=None, usable=None):
+        self._fetch = fetch
+        self._background_fetch = background_fetch or fetch
+        self._usable = usable
+        self.ttl = ttl
+        self._clock = clock
+        self._today = today
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._fetched_at = None
+        self._fetched_on = None
+        self._refreshing = False
+        self.version = 0
+
+    def get(self):
+        '''Returns the cached snapshot, only blocking on a fetch if there is
+        no snapshot for today yet'''
+        snapshot = self._snapshot
+        if snapshot is None:
+            METRICS.cache_hit('leaves', False)
+            return self.refresh()
+        today = self._today()
+        if self._fetched_on != today:
+            METRICS.cache_hit('leaves', False)
+            try:
+                return self.refresh()
+            except Exception as e:
+                if self._usable is None or not self._usable(snapshot, today):
+                    raise
+                log.warning("Leave refresh failed, serving the previous "
+                            "day's snapshot error=%s", e)
+                # served as today's until the next refresh, once the TTL
+                # has passed
+                with self._lock:
+                    self._fetched_at = self._clock()
+                    self._fetched_on = today
+                return snapshot
+        METRICS.cache_hit('leaves')
+        if self._clock() - self._fetched_at >= self.ttl:
+            self._refresh_in_background()
+        return snapshot
+
+    def refresh(self, background=False):
+        '''Fetches a new snapshot, stores and returns it'''
+        fetched_on = self._today()
+        fetch = self._background_fetch if background else self._fetch
+        return self.set(fetch(), fetched_on)
+
+    def set(self, snapshot, fetched_on=None, stale=False):
+        '''Stores SNAPSHOT, fetched on FETCHED_ON (default today), as though
+        it had just been fetched. If STALE, it is served but refreshed in the
+        background on the next get(). The version only changes if SNAPSHOT
+        isn't the one already stored, e.g. when nothing has been modified'''
+        with self._lock:
+            if snapshot is not self._snapshot:
+                self._snapshot = snapshot
+                self.version += 1
+            self._fetched_at = self._clock() - (self.ttl if stale else 0)
+            self._fetched_on = fetched_on or self._today()
+        return snapshot
+
+    def peek(self):
+        '''Returns the cached snapshot, if any, without fetching'''
+        return self._snapshot
+
+    def update(self, change):
+        '''Replaces the cached snapshot with CHANGE(snapshot), e.g. to apply
+        a pushed update, without changing when it is next refreshed. Does
+        nothing if there is no snapshot yet'''
+        with self._lock:
+            if self._snapshot is None:
+                return None
+            self._snapshot = change(self._snapshot)
+            self.version += 1
+            return self._snapshot
+
+    def invalidate(self):
+        '''Drops the snapshot so the next get() fetches a fresh one'''
+        with self._lock:
+            self._snapshot = None
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh(background=True)
+        except Exception as e: # keep serving the last good snapshot
+            log.warning("Background leave refresh failed error=%s", e)
+            # and only try again once the TTL has passed again
+            with self._lock:
+                self._fetched_at = self._clock()
+        finally:
+            self._refreshing = False
+
+def _bigrams(name):
+    padded = '^' + name + '$'
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def _edit_distance(a, b, limit):
+    '''Levenshtein distance between A and B, counting a transposition of
+    adjacent letters as one edit. Gives up with limit + 1 once above LIMIT'''
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1,
+                             current[j - 1] + 1,
+                             previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] \
+               and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+class NameSearchIndex(object):
+    '''Finds the names a typed name may be the start or a misspelling of.
+    Names starting with it are found by bisecting a sorted list; for
+    misspellings, only the names sharing the most letter pairs with it have
+    their edit distance checked, keeping lookups cheap for big directories'''
+
+    def __init__(self, names):
+        self._names = sorted(names)
+        self._bigrams = defaultdict(list)
+        for name in self._names:
+            for bigram in _bigrams(name):
+                self._bigrams[bigram].append(name)
+
+    def starting_with(self, prefix, limit=MAX_PREFIX_MATCHES):
+        '''The first LIMIT names, alphabetically, starting with PREFIX,
+        excluding PREFIX itself'''
+        i = bisect_left(self._names, prefix)
+        names = []
+        while i < len(self._names) and len(names) < limit \
+              and self._names[i].startswith(prefix):
+            if self._names[i] != prefix:
+                names.append(self._names[i])
+            i += 1
+        return names
+
+    def misspellings_of(self, typed, max_distance):
+        '''(name, distance) pairs for names within MAX_DISTANCE edits'''
+        shared = Counter()
+        for bigram in _bigrams(typed):
+            shared.update(self._bigrams.get(bigram, ()))
+        return [(name, distance)
+                for name, _ in shared.most_common(MAX_TYPO_CHECKS)
+                if name != typed and abs(len(name) - len(typed)) <= max_distance
+                for distance in [_edit_distance(name, typed, max_distance)]
+                if distance <= max_distance]
+
+    def search(self, typed):
+        '''(name, score) pairs for names TYPED may refer to, lower scores
+        being better matches: 0 if exact, 1 for names starting with it, and
+        1 + the number of edits for misspellings'''
+        results = {}
+        if len(typed) >= MIN_TYPO_LENGTH:
+            max_distance = 1 if len(typed) < 8 else 2
+            for name, distance in self.misspellings_of(typed, max_distance):
+                results[name] = 1 + distance
+        if len(typed) >= MIN_PREFIX_LENGTH:
+            for name in self.starting_with(typed):
+                results[name] = 1
+        i = bisect_left(self._names, typed)
+        if i < len(self._names) and self._names[i] == typed:
+            results[typed] = 0
+        return list(results.items())
+
+class LeaveCalendar(object):
+    '''Leaves from START to END indexed by date, so who is out on any day in
+    range is a dictionary lookup away. TIMEOFFS is a dictionary of
+    (employee id, Leave) pairs, as returned by BambooHrClient.get_timeoffs'''
+
+    def __init__(self, timeoffs, start, end):
+        self.timeoffs = timeoffs
+        self.start = start
+        self.end = end
+        self._days = defaultdict(list)
+        for emp_id, leave in timeoffs.values():
+            for day in self._days_of(leave):
+                self._days[day].append((emp_id, leave))
+
+    def covers(self, start, end):
+        return self.start <= start and end <= self.end
+
+    def _days_of(self, leave):
+        day = max(leave.start, self.start)
+        while day <= min(leave.end, self.end):
+            yield day
+            day += timedelta(1)
+
+    def updated(self, changed, removed):
+        '''A copy with CHANGED time off requests ((employee id, Leave) pairs
+        indexed by request id) added or replaced and REMOVED request ids
+        dropped. Only the days they touch are reindexed'''
+        calendar = LeaveCalendar({}, self.start, self.end)
+        calendar.timeoffs = dict(self.timeoffs)
+        calendar._days = defaultdict(list, self._days)
+        copied = set()
+        def day_list(day):
+            if day not in copied:
+                calendar._days[day] = list(calendar._days.get(day, ()))
+                copied.add(day)
+            return calendar._days[day]
+        for request_id in chain(removed, changed):
+            timeoff = calendar.timeoffs.pop(request_id, None)
+            if timeoff is not None:
+                for day in self._days_of(timeoff[1]):
+                    day_list(day).remove(timeoff)
+        for request_id, timeoff in changed.items():
+            calendar.timeoffs[request_id] = timeoff
+            for day in self._days_of(timeoff[1]):
+                day_list(day).append(timeoff)
+        for day in copied:
+            if len(calendar._days[day]) == 0:
+                del calendar._days[day]
+        return calendar
+
+    def between(self, start, end):
+        '''List of (employee id, Leave) pairs for all leaves overlapping
+        START to END, which must be within the calendar'''
+        if start == end:
+            return list(self._days.get(start, ()))
+        timeoffs = []
+        seen = set()
+        day = start
+        while day <= end:
+            for timeoff in self._days.get(day, ()):
+                if timeoff not in seen:
+                    seen.add(timeoff)
+                    timeoffs.append(timeoff)
+            day += timedelta(1)
+        return timeoffs
+
 class WhosOutChecker(object):
 
-    def __init__(self, api_key, company, host=None):
+    def __init__(self, api_key, company, host=None,
+                 leave_ttl=DEFAULT_LEAVE_TTL,
+                 leave_window=DEFAULT_LEAVE_WINDOW, load=True):
+        '''Fetches the directory and leave calendar unless LOAD is False, in
+        which case load_async() should be awaited before querying'''
         self.bamboohr_client = BambooHrClient(api_key, company, host)
-        self.emps = self.bamboohr_client.get_employees_directory()
-        self.namesets = self._build_namesets(self.emps)
+        self._directory = Directory({}, {}, {})
+        self._directory_lock = threading.Lock() # held while patching
+        self.directory_version = 0
+        self.leave_window = leave_window
+        self.leaves = LeaveCache(
+            self._fetch_leave_calendar, leave_ttl,
+            background_fetch=lambda: self._fetch_leave_calendar(BACKGROUND),
+            usable=lambda calendar, day: calendar.covers(day, day))
+        self._search_index = (None, None) # (namesets, index built from them)
+        self._whos_out_replies = {} # (start, end) -> (version, reply)
+        if load:
+            run_concurrently(self.load_async())
+
+    async def load_async(self, priority=INTERACTIVE):
+        '''Fetches the employees directory and leave calendar concurrently,
+        at PRIORITY'''
+        client = AsyncBambooHrClient(self.bamboohr_client)
+        start, end = self._get_leave_window()
+        emps, timeoffs = await asyncio.gather(
+            client.get_employees_directory(priority),
+            client.get_timeoffs(start, end, priority))
+        self._set_directory(Directory(emps, self._build_namesets(emps),
+                                      self._build_teams(emps)))
+        self.leaves.set(LeaveCalendar(timeoffs, start, end), start)
+
+    def _set_directory(self, directory):
+        self._directory = directory
+        self.directory_version += 1
+
+    def get_snapshot(self):
+        '''The directory, its indexes and leave calendar, for
+        restore_snapshot'''
+        directory = self._directory
+        return {'emps': directory.emps,
+                'namesets': directory.namesets,
+                'teams': directory.teams,
+                'leaves': self.leaves.peek()}
+
+    def restore_snapshot(self, snapshot):
+        '''Serve from a snapshot saved by get_snapshot, e.g. on an earlier
+        run. Its leave calendar is refreshed in the background on first use'''
+        self._set_directory(Directory(snapshot['emps'], snapshot['namesets'],
+                                      snapshot['teams']))
+        if snapshot['leaves'] is not None:
+            self.leaves.set(snapshot['leaves'], stale=True)
+
+    @property
+    def emps(self):
+        return self._directory.emps
+
+    @property
+    def namesets(self):
+        return self._directory.namesets
+
+    @property
+    def teams(self):
+        return self._directory.teams
 
     @staticmethod
-    def _build_namesets(employees):
-        '''Maps all derived employee names to lists of employee ids
-        they may refer to, for speedy querying'''
-        namesets = defaultdict(set) # default dict of names - empIds
+    def _get_names(emp):
+        '''All the normalised names an employee may be referred to by, each
+        once'''
+        names = []
+        for name in (emp.display, emp.first, emp.last, emp.nick):
+            if name is not None:
+                names.extend(_split_name(name))
+        return tuple(dict.fromkeys(names))
+
+    @staticmethod
+    def _get_teams(emp):
+        '''The normalised department, division and location of an employee,
+        each once'''
+        return tuple(dict.fromkeys(
+            _normalise_team(team) for team in
+            (emp.department, emp.division, emp.location) if team is not None))
+
+    @staticmethod
+    def _build_index(employees, get_keys):
+        '''Maps every key GET_KEYS gives for each of EMPLOYEES to a sorted
+        array of the ids of the employees with that key'''
+        keys_to_ids = defaultdict(set)
         for emp_id, emp in employees.items():
-            names = sum((re.split('[ -]', _normalise_name(name))
-                         for name in emp if name is not None), [])
-            for name in names:
-                namesets[name].add(emp_id)
-        return namesets
+            for key in get_keys(emp):
+                keys_to_ids[key].add(emp_id)
+        return {sys.intern(key): array(POSTING_TYPECODE, sorted(emp_ids))
+                for key, emp_ids in keys_to_ids.items()}
+
+    @classmethod
+    def _build_namesets(cls, employees):
+        '''Maps all derived employee names to sorted arrays of employee ids
+        they may refer to, for speedy querying'''
+        return cls._build_index(employees, cls._get_names)
+
+    @classmethod
+    def _build_teams(cls, employees):
+        '''Maps departments, divisions and locations to sorted arrays of the
+        ids of the employees in them'''
+        return cls._build_index(employees, cls._get_teams)
+
+    @staticmethod
+    def _patch_index(index, old_emps, changed, removed, get_keys):
+        '''Returns a copy of INDEX (built by _build_index with GET_KEYS)
+        updated for CHANGED employees (new or updated, indexed by id) and
+        REMOVED employee ids. Only the arrays touched are rebuilt, so INDEX
+        itself is left as it was'''
+        removals = defaultdict(set)
+        additions = defaultdict(set)
+        for emp_id in chain(removed, changed):
+            if emp_id in old_emps:
+                for key in get_keys(old_emps[emp_id]):
+                    removals[key].add(emp_id)
+        for emp_id, emp in changed.items():
+            for key in get_keys(emp):
+                additions[key].add(emp_id)
+        index = dict(index)
+        for key in set(removals) | set(additions):
+            emp_ids = (set(index.get(key, ())) - removals[key]) \
+                      | additions[key]
+            if len(emp_ids) == 0:
+                del index[key]
+            else:
+                index[sys.intern(key)] = array(POSTING_TYPECODE,
+                                               sorted(emp_ids))
+        return index
+
+    @classmethod
+    def _patch_directory(cls, old, emps, changed, removed):
+        '''Directory of EMPS, with OLD's indexes patched for CHANGED and
+        REMOVED employees'''
+        return Directory(
+            emps,
+            cls._patch_index(old.namesets, old.emps, changed, removed,
+                             cls._get_names),
+            cls._patch_index(old.teams, old.emps, changed, removed,
+                             cls._get_teams))
+
+    def refresh_directory(self):
+        '''Fetches the employees directory again and patches the namesets
+        and teams for whoever has been added, removed, renamed or moved since
+        the last fetch'''
+        emps = self.bamboohr_client.get_employees_directory(BACKGROUND)
+        with self._directory_lock:
+            old = self._directory
+            if emps is old.emps: # not modified since the last fetch
+                return
+            changed = {emp_id: emp for emp_id, emp in emps.items()
+                       if old.emps.get(emp_id) != emp}
+            removed = [emp_id for emp_id in old.emps if emp_id not in emps]
+            if len(changed) == 0 and len(removed) == 0:
+                return
+            self._set_directory(self._patch_directory(old, emps, changed,
+                                                      removed))
+
+    def apply_employee_changes(self, changed, removed):
+        '''Applies CHANGED (new or updated Employees, indexed by id) and
+        REMOVED employee ids pushed from BambooHR, without a fetch'''
+        with self._directory_lock:
+            old = self._directory
+            changed = {emp_id: emp for emp_id, emp in changed.items()
+                       if old.emps.get(emp_id) != emp}
+            removed = [emp_id for emp_id in removed if emp_id in old.emps]
+            if len(changed) == 0 and len(removed) == 0:
+                return
+            emps = dict(old.emps)
+            emps.update(changed)
+            for emp_id in removed:
+                del emps[emp_id]
+            self._set_directory(self._patch_directory(old, emps, changed,
+                                                      removed))
+
+    def apply_timeoff_changes(self, changed, removed):
+        '''Applies CHANGED time off requests ((employee id, Leave) pairs
+        indexed by request id) and REMOVED request ids pushed from BambooHR
+        to the leave calendar, without a fetch. Ignored if there is no
+        calendar yet, as the first fetch will include them'''
+        self.leaves.update(lambda calendar: calendar.updated(changed, removed))
 
     @staticmethod
     def _get_employee_ids_from_name(typed_name, namesets):
         '''Get a list of employee ids that a typed name can refer to'''
-        typed_name = _normalise_name(typed_name)
-        typed_names = re.split('[ -]', typed_name)
-        match_sets = [namesets[tn] for tn in typed_names if tn in namesets]
+        return WhosOutChecker._get_employee_ids_from_names(
+            _split_typed_name(typed_name), namesets)
+
+    @staticmethod
+    def _get_employee_ids_from_names(names, namesets):
+        '''Get a list of employee ids with all of NAMES, as split by
+        _split_name'''
+        match_sets = sorted((namesets[name] for name in names
+                             if name in namesets), key=len)
         if len(match_sets) == 0:
             return []
-        intersection = set(match_sets[0])
-        for i in range(1, len(match_sets)):
-            intersection.intersection_update(match_sets[i])
-        return list(intersection)
+        intersection = list(match_sets[0])
+        for match_set in match_sets[1:]:
+            intersection = _intersect_sorted(intersection, match_set)
+        return intersection
 
-    def get_whos_out(self):
-        '''Get a list of who's out, each element as (Employee, Leave)'''
-        leaves = self.bamboohr_client.get_timeoff_whosout()
-        return [(self.emps[emp_id], leave) for emp_id, leave in leaves.items()]
+    def _get_search_index(self, namesets):
+        indexed_namesets, index = self._search_index
+        METRICS.cache_hit('search_index', indexed_namesets is namesets)
+        if indexed_namesets is not namesets:
+            index = NameSearchIndex(namesets.keys())
+            self._search_index = (namesets, index)
+        return index
 
-    def where_is(self, name):
-        '''Returns a list of (Employee, Leave) pairs for employees matching
-        NAME; Leave will be None if the employee is not currently on leave'''
-        print("where_is called with name=", name)
-        matching_emps = sorted(
-            self._get_employee_ids_from_name(name, self.namesets))
-        if len(matching_emps) == 0:
+    def _search_employee_ids(self, typed_name, namesets):
+        '''Get a ranked list of employee ids with names starting with, or
+        close to, the typed name, best matches first'''
+        index = self._get_search_index(namesets)
+        scores = None
+        for typed in _split_typed_name(typed_name):
+            typed_scores = {}
+            for name, score in index.search(typed):
+                for emp_id in namesets[name]:
+                    typed_scores[emp_id] = min(score,
+                                               typed_scores.get(emp_id, score))
+            if len(typed_scores) == 0:
+                continue
+            if scores is None:
+                scores = typed_scores
+            else:
+                scores = {emp_id: score + typed_scores[emp_id]
+                          for emp_id, score in scores.items()
+                          if emp_id in typed_scores}
+        if not scores:
             return []
-        current_leaves = self.bamboohr_client.get_timeoff_whosout()
-        return [(self.emps[x], current_leaves.get(x)) for x in matching_emps]
+        return sorted(scores, key=lambda x: (scores[x], x))[:MAX_SUGGESTIONS]
+
+    @METRICS.timed('nameset_lookup')
+    def _find_employee_ids(self, name, namesets, fuzzy):
+        '''(employee ids, whether they came from a fuzzy search)'''
+        emp_ids = self._get_employee_ids_from_name(name, namesets)
+        if len(emp_ids) == 0 and fuzzy:
+            return self._search_employee_ids(name, namesets), True
+        return emp_ids, False
+
+    def _get_leave_window(self):
+        start = date.today()
+        return (start, start + timedelta(self.leave_window - 1))
+
+    def _fetch_leave_calendar(self, priority=INTERACTIVE):
+        start, end = self._get_leave_window()
+        timeoffs = self.bamboohr_client.get_timeoffs(start, end, priority)
+        calendar = self.leaves.peek()
+        if calendar is not None and calendar.timeoffs is timeoffs:
+            return calendar # not modified since the last fetch
+        return LeaveCalendar(timeoffs, start, end)
+
+    def _get_timeoffs(self, start, end):
+        '''(employee id, Leave) pairs for START to END, defaulting to today.
+        Days outside the cached leave calendar are fetched directly'''
+        start = start or date.today()
+        end = end or start
+        calendar = self.leaves.get()
+        covered = calendar.covers(start, end)
+        METRICS.cache_hit('leave_calendar', covered)
+        if covered:
+            return calendar.between(start, end)
+        return [(emp_id, leave) for emp_id, leave
+                in self.bamboohr_client.get_timeoffs(start, end).values()
+                if leave.start <= end and leave.end >= start]
+
+    def get_whos_out(self, start=None, end=None):
+        '''Get a list of who's out, each element as (Employee, Leave). By
+        default for today, otherwise for any day from START to END'''
+        emps = self.emps
+        return [(emps[emp_id], leave)
+                for emp_id, leave in self._get_timeoffs(start, end)
+                if emp_id in emps]
+
+    def whos_out_in(self, team, start=None, end=None):
+        '''Like get_whos_out, but only for employees in TEAM, a department,
+        division or location. None if nobody is in TEAM'''
+        directory = self._directory
+        members = directory.teams.get(_normalise_team(team))
+        if members is None:
+            return None
+        return [(directory.emps[emp_id], leave)
+                for emp_id, leave in self._get_timeoffs(start, end)
+                if _contains_sorted(members, emp_id)]
 
+    def get_whos_out_reply(self, start=None, end=None):
+        '''build_whosout_reply for get_whos_out(START, END). Replies for
+        days in the leave calendar are rendered once per version of the
+        directory and leave calendar, then served from memory'''
+        start = start or date.today()
+        end = end or start
+        calendar = self.leaves.get()
+        version = (self.directory_version, self.leaves.version)
+        cached = self._whos_out_replies.get((start, end))
+        if cached is not None and cached[0] == version:
+            METRICS.cache_hit('whos_out_reply')
+            return cached[1]
+        METRICS.cache_hit('whos_out_reply', False)
+        reply = build_whosout_reply(self.get_whos_out(start, end))
+        if calendar.covers(start, end):
+            if len(self._whos_out_replies) >= MAX_CACHED_REPLIES:
+                self._whos_out_replies = {}
+            self._whos_out_replies[(start, end)] = (version, reply)
+        return reply
+
+    def where_is(self, name, fuzzy=True, start=None, end=None):
+        '''Returns a list of (Employee, Leave) pairs for employees matching
+        NAME; Leave will be None if the employee is not on leave today, or
+        on any day from START to END if given.
+        If nobody's name matches exactly and FUZZY is set, returns the best
+        few employees whose names start with, or are close to, NAME'''
+        log.debug("where_is name=%r fuzzy=%s start=%s end=%s",
+                  name, fuzzy, start, end)
+        return self.where_are([name], fuzzy, start, end)[0].matches
+
+    def which_on_leave(self, names):
+        '''The subset of NAMES that match, exactly rather than fuzzily,
+        anyone on leave today. Unlike typed names, NAMES (e.g. everyone's
+        HipChat name) are split without going through the typed name cache'''
+        namesets = self._directory.namesets
+        on_leave = {emp_id for emp_id, _ in self._get_timeoffs(None, None)}
+        return {name for name in names
+                if any(emp_id in on_leave for emp_id in
+                       self._get_employee_ids_from_names(_split_name(name),
+                                                         namesets))}
+
+    def where_are(self, names, fuzzy=True, start=None, end=None):
+        '''Like where_is, but for each of NAMES in turn, all resolved against
+        the same leave snapshot. Returns a list of Whereabouts in NAMES
+        order, flagging those that are fuzzy matches'''
+        directory = self._directory
+        found = [self._find_employee_ids(name, directory.namesets, fuzzy)
+                 for name in names]
+        if not any(emp_ids for emp_ids, _ in found):
+            return [Whereabouts([], is_fuzzy) for _, is_fuzzy in found]
+        leaves = {}
+        for emp_id, leave in self._get_timeoffs(start, end):
+            leaves.setdefault(emp_id, leave)
+        return [Whereabouts([(directory.emps[x], leaves.get(x))
+                             for x in emp_ids], is_fuzzy)
+                for emp_ids, is_fuzzy in found]
+
+@lru_cache(maxsize=LINE_CACHE_SIZE)
+def _format_whosout_line(emp, leave):
+    return "{}{}: {}/{}-{}/{}".format(
+        emp.display,
+        ' (' + emp.nick + ')' if emp.nick is not None else '',
+        leave.start.day,
+        leave.start.month,
+        leave.end.day,
+        leave.end.month)
+
+@METRICS.timed('build_whosout_reply')
 def build_whosout_reply(timeoffs):
-    return "\n".join(
-        sorted("{}{}: {}/{}-{}/{}".format(
-            emp.display,
-            ' (' + emp.nick + ')' if emp.nick is not None else '',
-            leave.start.day,
-            leave.start.month,
-            leave.end.day,
-            leave.end.month) for (emp, leave) in timeoffs))
-
-def build_whereis_reply(name, timeoffs):
+    return "\n".join(sorted(_format_whosout_line(emp, leave)
+                            for (emp, leave) in timeoffs))
+
+@METRICS.timed('build_whereis_reply')
+def build_whereis_reply(name, timeoffs, when=None, fuzzy=False):
+    '''Reply for where_is results. WHEN describes the day(s) asked about,
+    e.g. "tomorrow", if not today. FUZZY results are the closest matches to
+    NAME, and are listed best first'''
     if len(timeoffs) == 0:
         return "I could not find any employee named " + name
-    return '\n'.join(
-        sorted( ### TODO : just if-else on the pre-format string & use named {}s
-            "{}{} is currently on leave, from {}/{} to {}/{}".format(
-                emp.display,
-                ' (' + emp.nick + ')' if emp.nick is not None else '',
-                leave.start.day,
-                leave.start.month,
-                leave.end.day,
-                leave.end.month) if leave is not None else
-            "{}{} is not on leave at the moment".format(
-                emp.display,
-                ' (' + emp.nick + ')' if emp.nick is not None else '')
-            for (emp, leave) in timeoffs))
+    lines = [_format_whereis_line(emp, leave, when)
+             for (emp, leave) in timeoffs]
+    if fuzzy:
+        return '\n'.join(["I couldn't find {}; closest matches:".format(name)]
+                         + lines)
+    return '\n'.join(sorted(lines))
+
+def build_whereare_reply(names, results, when=None):
+    '''One reply for where_are RESULTS, taking each of NAMES in turn'''
+    return '\n'.join(build_whereis_reply(name, matches, when, fuzzy)
+                     for name, (matches, fuzzy) in zip(names, results))
+
+@lru_cache(maxsize=LINE_CACHE_SIZE)
+def _format_whereis_line(emp, leave, when):
+    nick = ' (' + emp.nick + ')' if emp.nick is not None else ''
+    if leave is None:
+        return "{}{} {}".format(
+            emp.display, nick,
+            "is not on leave " + when if when else
+            "is not on leave at the moment")
+    return "{}{} {} from {}/{} to {}/{}".format(
+        emp.display, nick,
+        "is on leave " + when + "," if when else "is currently on leave,",
+        leave.start.day,
+        leave.start.month,
+        leave.end.day,
+        leave.end.month)
+
+@lru_cache(maxsize=MAX_CACHED_REPLIES)
+def chunk_reply(reply, size):
+    '''Splits REPLY into a tuple of messages of at most SIZE characters,
+    breaking between lines wherever possible'''
+    if len(reply) <= size:
+        return (reply,)
+    chunks = []
+    chunk = None
+    for line in reply.split('\n'):
+        while len(line) > size:
+            if chunk is not None:
+                chunks.append(chunk)
+                chunk = None
+            chunks.append(line[:size])
+            line = line[size:]
+        if chunk is None:
+            chunk = line
+        elif len(chunk) + 1 + len(line) <= size:
+            chunk += '\n' + line
+        else:
+            chunks.append(chunk)
+            chunk = line
+    chunks.append(chunk)
+    return tuple(chunks)
 
 
 ### Functions just called from __main__ ###
 
+BATCH_FORMATS = ['jsonl', 'csv']
+BATCH_FIELDS = ['name', 'employee', 'fuzzy', 'on_leave', 'start', 'end']
+
 def _parse_bamboo_credentials(path):
     config = configparser.ConfigParser()
     config.read(path)
-    return config.get('BambooHR', 'ApiKey')
+    return config['BambooHR']
+
+def _read_names(f):
+    """Names to check from F, one per line, skipping blank lines"""
+    return [line.strip() for line in f if line.strip()]
+
+def _batch_rows(names, results):
+    """A row per employee matching each name, or a row with no employee if
+    nobody matches. Employees that are only the closest matches to a name
+    nobody has are marked fuzzy"""
+    for name, (matches, fuzzy) in zip(names, results):
+        if len(matches) == 0:
+            yield {'name': name, 'employee': None, 'fuzzy': False,
+                   'on_leave': False, 'start': None, 'end': None}
+        for emp, leave in matches:
+            yield {'name': name,
+                   'employee': emp.display,
+                   'fuzzy': fuzzy,
+                   'on_leave': leave is not None,
+                   'start': str(leave.start) if leave is not None else None,
+                   'end': str(leave.end) if leave is not None else None}
+
+def write_batch(names, results, out, fmt='jsonl'):
+    """Writes where_are RESULTS for NAMES to OUT as JSON Lines or CSV"""
+    rows = _batch_rows(names, results)
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, BATCH_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
 
 def _parse_command_line_args():
     parser = argparse.ArgumentParser(
@@ -108,6 +856,29 @@ def _parse_command_line_args():
         nargs="?",
         help="""Path to file containing BambooHR credentials. \
         If not specified, uses ../../holidaybot_credentials.cfg""")
+    parser.add_argument(
+        '--company',
+        help="BambooHR company. If not specified, uses the Company in the \
+        credentials file, or swiftkey")
+    parser.add_argument(
+        '--host',
+        help="BambooHR API host. If not specified, uses the Host in the \
+        credentials file, or https://api.bamboohr.com")
+    parser.add_argument(
+        '-b', '--batch',
+        metavar='FILE',
+        type=argparse.FileType('r'),
+        help="Check every name in FILE, one per line ('-' for stdin), \
+        against a single download of the directory and leaves")
+    parser.add_argument(
+        '-f', '--format',
+        choices=BATCH_FORMATS,
+        default='jsonl',
+        help="Output format for --batch. Defaults to jsonl")
+    parser.add_argument(
+        '-w', '--when',
+        help="Day(s) to check, e.g. tomorrow, 'next week', 'on 21/5'. \
+        Defaults to today")
     parser.add_argument(
         'person_to_check',
         metavar='NAME',
@@ -119,10 +890,23 @@ def _parse_command_line_args():
 
 if __name__ == '__main__':
     ARGS = _parse_command_line_args()
-    API_KEY = _parse_bamboo_credentials(ARGS.credentials)
-    CHECKER = WhosOutChecker(API_KEY, 'swiftkey')
-    if ARGS.person_to_check is None:
-        print(build_whosout_reply(CHECKER.get_whos_out()))
+    CREDENTIALS = _parse_bamboo_credentials(ARGS.credentials)
+    DAYS = parse_when(ARGS.when)
+    if DAYS is None:
+        sys.exit("Sorry, I don't know when '{}' is".format(ARGS.when))
+    CHECKER = WhosOutChecker(CREDENTIALS['ApiKey'],
+                             ARGS.company or CREDENTIALS.get('Company',
+                                                             'swiftkey'),
+                             ARGS.host or CREDENTIALS.get('Host'))
+    if ARGS.batch is not None:
+        NAMES = _read_names(ARGS.batch)
+        write_batch(NAMES, CHECKER.where_are(NAMES, start=DAYS[0],
+                                             end=DAYS[1]),
+                    sys.stdout, ARGS.format)
+    elif ARGS.person_to_check is None:
+        print(build_whosout_reply(CHECKER.get_whos_out(*DAYS)))
     else:
-        WHEREABOUTS = CHECKER.where_is(ARGS.person_to_check)
-        print(build_whereis_reply(ARGS.person_to_check, WHEREABOUTS))
+        WHEREABOUTS = CHECKER.where_are([ARGS.person_to_check],
+                                        start=DAYS[0], end=DAYS[1])[0]
+        print(build_whereis_reply(ARGS.person_to_check, WHEREABOUTS.matches,
+                                  ARGS.when, WHEREABOUTS.fuzzy))
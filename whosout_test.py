@@ -1,18 +1,23 @@
 from gevent import monkey
 monkey.patch_all()
-import bottle
+import bhr_client
 import gevent
+import io
+import json
+import requests
+import time
 import unittest
 import whosout
 
+from array import array
 from bhr_client import Employee, Leave
-from bottle import route
-from datetime import date
-from whosout import WhosOutChecker
-
-TEST_API_KEY = 'testapikey'
-TEST_COMPANY = 'reynholm-industries'
-TEST_HOST = 'http://localhost:8080'
+# the stub BambooHR server is shared with the client tests
+from bhr_client_test import (CONDITIONAL_COMPANY, CONDITIONAL_REQUESTS,
+                             NEXT_WEEK, SLOW_COMPANY, SLOW_RESPONSE_DELAY,
+                             TEST_API_KEY, TEST_COMPANY, TEST_HOST, TODAY,
+                             TOMORROW, run_fn)
+from datetime import date, timedelta
+from whosout import LeaveCache, NameSearchIndex, Whereabouts, WhosOutChecker
 
 class TestWhosout(unittest.TestCase):
 
@@ -24,15 +29,48 @@ class TestWhosout(unittest.TestCase):
         print('number of timeoffs returned:', len(timeoffs))
         expected = [
             (Employee('Sarah Surely', 'Sarah', 'Surely', None),
-             Leave(date(2015, 5, 4), date(2015, 5, 4))),
+             Leave(TODAY, TODAY)),
+            (Employee('Charlie Brown', 'Charlie', 'Brown', None),
+             Leave(TODAY, NEXT_WEEK))]
+        self.assertEqual(frozenset(expected), frozenset(timeoffs))
+
+    def test_get_whos_out_tomorrow(self):
+        timeoffs = self.checker.get_whos_out(TOMORROW, TOMORROW)
+        expected = [
             (Employee('Charlie Brown', 'Charlie', 'Brown', None),
-             Leave(date(2015, 5, 21), date(2015, 5, 28)))]
+             Leave(TODAY, NEXT_WEEK)),
+            (Employee('Barry Smith', 'Barry', 'Smith', None),
+             Leave(TOMORROW, TOMORROW))]
         self.assertEqual(frozenset(expected), frozenset(timeoffs))
 
+    def test_get_whos_out_keeps_every_leave(self):
+        timeoffs = self.checker.get_whos_out(TODAY, NEXT_WEEK)
+        sarah = Employee('Sarah Surely', 'Sarah', 'Surely', None)
+        self.assertIn((sarah, Leave(TODAY, TODAY)), timeoffs)
+        self.assertIn((sarah, Leave(NEXT_WEEK, NEXT_WEEK)), timeoffs)
+        self.assertEqual(4, len(timeoffs))
+
+    def test_get_whos_out_answered_from_one_fetch(self):
+        self.checker.get_whos_out()
+        self.checker.get_whos_out(TOMORROW, TOMORROW)
+        self.checker.where_is('Barry', start=NEXT_WEEK, end=NEXT_WEEK)
+        self.assertEqual(1, self.checker.leaves.version)
+
+    def test_get_whos_out_beyond_window(self):
+        later = TODAY + timedelta(self.checker.leave_window + 30)
+        self.assertEqual([], self.checker.get_whos_out(later, later))
+
+    def test_where_is_on_day(self):
+        whereabouts = self.checker.where_is('Barry', start=TOMORROW,
+                                            end=TOMORROW)
+        expected = [(Employee('Barry Smith', 'Barry', 'Smith', None),
+                     Leave(TOMORROW, TOMORROW))]
+        self.assertEqual(expected, whereabouts)
+
     def test_where_is(self):
         whereabouts = self.checker.where_is('Sarah')
         expected = [(Employee('Sarah Surely', 'Sarah', 'Surely', None),
-                     Leave(date(2015, 5, 4), date(2015, 5, 4)))]
+                     Leave(TODAY, TODAY))]
         self.assertEqual(frozenset(expected), frozenset(whereabouts))
 
     def test_where_is_hyphen_omitted_matches_name(self):
@@ -40,6 +78,159 @@ class TestWhosout(unittest.TestCase):
         expected = {(Employee('Mary-Jane Spiderman', 'Mary-Jane', 'Spiderman', 'M-J'), None)}
         self.assertSetEqual(expected, frozenset(whereabouts))
 
+    def test_where_are(self):
+        whereabouts = self.checker.where_are(['Sarah', 'Polly', 'Barry'])
+        expected = [
+            Whereabouts([(Employee('Sarah Surely', 'Sarah', 'Surely', None),
+                          Leave(TODAY, TODAY))], False),
+            Whereabouts([], True),
+            Whereabouts([(Employee('Barry Smith', 'Barry', 'Smith', None),
+                          None)], False)]
+        self.assertEqual(expected, whereabouts)
+        self.assertEqual(1, self.checker.leaves.version)
+
+    def test_build_whereare_reply(self):
+        names = ['Sarah', 'Polly']
+        reply = whosout.build_whereare_reply(
+            names, self.checker.where_are(names))
+        self.assertEqual(
+            'Sarah Surely is currently on leave, from {0}/{1} to {0}/{1}\n'
+            'I could not find any employee named Polly'.format(
+                TODAY.day, TODAY.month), reply)
+
+    def test_which_on_leave(self):
+        self.assertEqual({'Sarah Surely', 'charlie'},
+                         self.checker.which_on_leave(
+                             ['Sarah Surely', 'charlie', 'Barry Smith',
+                              'Polly', 'Char']))
+
+    def test_which_on_leave_skips_typed_name_cache(self):
+        whosout._split_typed_name.cache_clear()
+        self.checker.which_on_leave(['Sarah Surely', 'Barry Smith'])
+        self.assertEqual(0, whosout._split_typed_name.cache_info().currsize)
+
+    def test_where_are_unknown(self):
+        self.assertEqual([Whereabouts([], True), Whereabouts([], True)],
+                         self.checker.where_are(['Polly', '']))
+        self.assertEqual(1, self.checker.leaves.version)
+
+    def test_load_async(self):
+        checker = WhosOutChecker(TEST_API_KEY, TEST_COMPANY, TEST_HOST,
+                                 load=False)
+        self.assertEqual({}, checker.emps)
+        bhr_client.run_concurrently(checker.load_async())
+        self.assertEqual(self.checker.emps, checker.emps)
+        self.assertEqual(self.checker.namesets, checker.namesets)
+        self.assertEqual(1, checker.leaves.version)
+
+    def test_refresh_directory(self):
+        emps = dict(self.checker.emps)
+        del emps[2] # Barry Smith leaves
+        emps[3] = Employee('Mary-Jane Watson', 'Mary-Jane', 'Watson', 'M-J')
+        emps[4] = Employee('Polly Shelby', 'Polly', 'Shelby', None)
+        self.checker.bamboohr_client.get_employees_directory = lambda priority: emps
+        old_namesets = self.checker.namesets
+        self.checker.refresh_directory()
+        self.assertEqual(emps, self.checker.emps)
+        self.assertEqual(WhosOutChecker._build_namesets(emps),
+                         self.checker.namesets)
+        self.assertIn('barry', old_namesets) # not modified in place
+        self.assertEqual([(emps[4], None)], self.checker.where_is('Polly'))
+        self.assertEqual([], self.checker.where_is('Spiderman'))
+        self.assertEqual([], self.checker.where_is('Barry'))
+
+    def test_whos_out_in(self):
+        emps = dict(self.checker.emps)
+        emps[50446] = emps[50446]._replace(department='Engineering',
+                                           location='London')
+        emps[60401] = emps[60401]._replace(department='Sales',
+                                           location='São Paulo')
+        emps[2] = emps[2]._replace(division='Engineering')
+        self.checker.bamboohr_client.get_employees_directory = lambda priority: emps
+        self.checker.refresh_directory()
+        self.assertEqual(WhosOutChecker._build_teams(emps),
+                         self.checker.teams)
+        self.assertEqual([(emps[50446], Leave(TODAY, TODAY))],
+                         self.checker.whos_out_in('engineering'))
+        self.assertEqual([(emps[2], Leave(TOMORROW, TOMORROW))],
+                         self.checker.whos_out_in(' Engineering ', TOMORROW,
+                                                  TOMORROW))
+        self.assertEqual([(emps[60401], Leave(TODAY, NEXT_WEEK))],
+                         self.checker.whos_out_in('sao  paulo'))
+        self.assertEqual([], self.checker.whos_out_in('London', TOMORROW,
+                                                      TOMORROW))
+        self.assertIsNone(self.checker.whos_out_in('Legal'))
+
+    def test_where_is_prefix(self):
+        whereabouts = self.checker.where_is('Char')
+        expected = [(Employee('Charlie Brown', 'Charlie', 'Brown', None),
+                     Leave(TODAY, NEXT_WEEK))]
+        self.assertEqual(expected, whereabouts)
+
+    def test_where_is_misspelt(self):
+        whereabouts = self.checker.where_is('Spidreman')
+        expected = [(Employee('Mary-Jane Spiderman', 'Mary-Jane', 'Spiderman', 'M-J'), None)]
+        self.assertEqual(expected, whereabouts)
+
+    def test_where_is_ranks_closest_matches_first(self):
+        whereabouts = self.checker.where_is('Sarh Surel')
+        self.assertEqual(['Sarah Surely'],
+                         [emp.display for emp, _ in whereabouts])
+        whereabouts = self.checker.where_is('Firs')
+        self.assertEqual(['Firstname Surname'],
+                         [emp.display for emp, _ in whereabouts])
+
+    def test_where_is_not_fuzzy(self):
+        self.assertEqual([], self.checker.where_is('Char', fuzzy=False))
+
+    def test_where_are_flags_fuzzy_matches(self):
+        exact, fuzzy = self.checker.where_are(['Charlie', 'Char'])
+        self.assertFalse(exact.fuzzy)
+        self.assertTrue(fuzzy.fuzzy)
+        self.assertEqual(exact.matches, fuzzy.matches)
+
+    def test_build_whereare_reply_fuzzy(self):
+        names = ['Sarah Surely', 'Sarh']
+        reply = whosout.build_whereare_reply(
+            names, self.checker.where_are(names))
+        lines = reply.split('\n')
+        self.assertEqual("I couldn't find Sarh; closest matches:", lines[1])
+        self.assertTrue(lines[2].startswith('Sarah Surely'))
+
+    def test_load_fetches_concurrently(self):
+        started = time.monotonic()
+        WhosOutChecker(TEST_API_KEY, SLOW_COMPANY, TEST_HOST)
+        self.assertLess(time.monotonic() - started, 2 * SLOW_RESPONSE_DELAY)
+
+    def test_namesets_are_sorted_arrays(self):
+        self.assertEqual(array('i', [50446]), self.checker.namesets['sarah'])
+        namesets = WhosOutChecker._build_namesets({
+            9: Employee('Ann Lee', 'Ann', 'Lee', None),
+            2: Employee('Bo Lee', 'Bo', 'Lee', 'Ann')})
+        self.assertEqual(array('i', [2, 9]), namesets['ann'])
+        self.assertEqual(array('i', [2, 9]), namesets['lee'])
+
+    def test_get_names_once_each(self):
+        self.assertEqual(('maryjane', 'ostergaard', 'zoe'),
+                         WhosOutChecker._get_names(Employee(
+                             'Mary-Jane Østergaard', 'Mary-Jane',
+                             'Østergaard', 'Zoë')))
+
+    def test_typed_names_cached(self):
+        whosout._split_typed_name.cache_clear()
+        self.checker.where_is('Sarah Surely')
+        self.checker.where_is('Sarah Surely')
+        self.assertEqual(('sarah', 'surely'),
+                         whosout._split_typed_name('Sarah Surely'))
+        self.assertEqual(1, whosout._split_typed_name.cache_info().misses)
+
+    def test_intersect_sorted(self):
+        self.assertEqual([3, 9], whosout._intersect_sorted(
+            array('i', [1, 3, 5, 9]), array('i', [0, 3, 4, 9, 12])))
+        self.assertEqual([], whosout._intersect_sorted(
+            array('i', [1, 2]), array('i', [3, 4])))
+        self.assertEqual([], whosout._intersect_sorted(array('i'), [1]))
+
     def test_where_is_unknown(self):
         result = self.checker.where_is("Polly")
         self.assertEqual(frozenset(), frozenset(result))
@@ -58,6 +249,91 @@ class TestWhosout(unittest.TestCase):
         self.assertIn('Sarah Surely: 4/5-4/5', reply)
         self.assertIn('Charlie Brown: 6/5-8/5', reply)
 
+    def test_get_whos_out_reply_rendered_once_per_version(self):
+        reply = self.checker.get_whos_out_reply()
+        self.assertEqual(whosout.build_whosout_reply(
+            self.checker.get_whos_out()), reply)
+        self.assertIs(reply, self.checker.get_whos_out_reply())
+        self.checker.leaves.refresh()
+        self.assertIsNot(reply, self.checker.get_whos_out_reply())
+        self.assertEqual(reply, self.checker.get_whos_out_reply())
+
+    def test_write_batch(self):
+        names = ['Sarah', 'Polly', 'Barry', 'Bary']
+        results = self.checker.where_are(names)
+        out = io.StringIO()
+        whosout.write_batch(names, results, out)
+        self.assertEqual(
+            [{'name': 'Sarah', 'employee': 'Sarah Surely', 'fuzzy': False,
+              'on_leave': True, 'start': str(TODAY), 'end': str(TODAY)},
+             {'name': 'Polly', 'employee': None, 'fuzzy': False,
+              'on_leave': False, 'start': None, 'end': None},
+             {'name': 'Barry', 'employee': 'Barry Smith', 'fuzzy': False,
+              'on_leave': False, 'start': None, 'end': None},
+             {'name': 'Bary', 'employee': 'Barry Smith', 'fuzzy': True,
+              'on_leave': False, 'start': None, 'end': None}],
+            [json.loads(line) for line in out.getvalue().splitlines()])
+        out = io.StringIO()
+        whosout.write_batch(names, results, out, 'csv')
+        self.assertEqual(['name,employee,fuzzy,on_leave,start,end',
+                          'Sarah,Sarah Surely,False,True,{0},{0}'.format(
+                              TODAY),
+                          'Polly,,False,False,,',
+                          'Barry,Barry Smith,False,False,,',
+                          'Bary,Barry Smith,True,False,,'],
+                         out.getvalue().splitlines())
+
+    def test_chunk_reply(self):
+        self.assertEqual(('',), whosout.chunk_reply('', 10))
+        self.assertEqual(('one\ntwo', 'three'),
+                         whosout.chunk_reply('one\ntwo\nthree', 8))
+        self.assertEqual(('a', 'bcdef', 'ghij', 'k'),
+                         whosout.chunk_reply('a\nbcdefghij\nk', 5))
+
+    def test_parse_when(self):
+        wednesday = date(2015, 5, 6)
+        self.assertEqual((wednesday, wednesday),
+                         whosout.parse_when(None, wednesday))
+        self.assertEqual((date(2015, 5, 7), date(2015, 5, 7)),
+                         whosout.parse_when(' tomorrow', wednesday))
+        self.assertEqual((date(2015, 5, 8), date(2015, 5, 8)),
+                         whosout.parse_when(' on Friday', wednesday))
+        self.assertEqual((wednesday, wednesday),
+                         whosout.parse_when('on wednesday', wednesday))
+        self.assertEqual((wednesday, date(2015, 5, 10)),
+                         whosout.parse_when('this week', wednesday))
+        self.assertEqual((date(2015, 5, 11), date(2015, 5, 17)),
+                         whosout.parse_when('next week', wednesday))
+        self.assertEqual((date(2015, 5, 21), date(2015, 5, 21)),
+                         whosout.parse_when('on 21/5', wednesday))
+        self.assertEqual((date(2016, 1, 2), date(2016, 1, 2)),
+                         whosout.parse_when('on 2/1', wednesday))
+        self.assertEqual((date(2016, 2, 29), date(2016, 2, 29)),
+                         whosout.parse_when('on 29/2', wednesday))
+        self.assertEqual((date(2104, 2, 29), date(2104, 2, 29)),
+                         whosout.parse_when('on 29/2', date(2096, 3, 1)))
+        self.assertIsNone(whosout.parse_when('on 30/2', wednesday))
+        self.assertEqual((date(2015, 5, 21), date(2015, 5, 21)),
+                         whosout.parse_when('on 2015-05-21', wednesday))
+        self.assertIsNone(whosout.parse_when('on blursday', wednesday))
+
+    def test_build_whereis_reply_on_day(self):
+        whereabouts = [(Employee('Sarah Surely', 'Sarah', 'Surely', None),
+                        Leave(date(2015, 5, 4), date(2015, 5, 4))),
+                       (Employee('Sarah Smith', 'Sarah', 'Smith', None), None)]
+        reply = whosout.build_whereis_reply('sarah', whereabouts, 'tomorrow')
+        self.assertIn('Sarah Surely is on leave tomorrow, from 4/5 to 4/5', reply)
+        self.assertIn('Sarah Smith is not on leave tomorrow', reply)
+
+    def test_build_whereis_reply_fuzzy_keeps_rank(self):
+        whereabouts = [(Employee('Sarah Surely', 'Sarah', 'Surely', None),
+                        None),
+                       (Employee('Sarah Smith', 'Sarah', 'Smith', None), None)]
+        reply = whosout.build_whereis_reply('sarh', whereabouts, fuzzy=True)
+        self.assertEqual("I couldn't find sarh; closest matches:\n"
+                         "Sarah Surely is not on leave at the moment\n"
+                         "Sarah Smith is not on leave at the moment", reply)
+
     def test_build_whereis_reply(self):
         whereabouts = [(Employee('Sarah Surely', 'Sarah', 'Surely', None),
                         Leave(date(2015, 5, 4), date(2015, 5, 4)))]
@@ -66,53 +342,142 @@ class TestWhosout(unittest.TestCase):
         self.assertIn("Sarah Surely is currently on leave", reply)
         self.assertIn('from 4/5 to 4/5', reply)
 
-@route("/api/gateway.php/" + TEST_COMPANY + "/v1/employees/directory")
-def directory_request_handler():
-    return """{
-    "fields": [
-    {"id":"displayName","type":"text","name":"Display name"},
-    {"id":"firstName","type":"text","name":"First name"},
-    {"id":"lastName","type":"text","name":"Last name"},
-    {"id":"nickname","type":"text","name":"Nick name"}],
-    "employees": [
-    {"id": "50446",
-     "displayName": "Sarah Surely",
-     "firstName": "Sarah",
-     "lastName": "Surely",
-     "nickname": null},
-    {"id": "001",
-     "displayName": "Firstname Surname",
-     "firstName": "First",
-     "lastName": "Last",
-     "nickname": "firstlast"},
-    {"id": "60401",
-     "displayName": "Charlie Brown",
-     "firstName": "Charlie",
-     "lastName": "Brown",
-     "nickname": null},
-    {"id": "002",
-     "displayName": "Barry Smith",
-     "firstName": "Barry",
-     "lastName": "Smith",
-     "nickname": null},
-    {"id": "003",
-     "displayName": "Mary-Jane Spiderman",
-     "firstName": "Mary-Jane",
-     "lastName": "Spiderman",
-     "nickname": "M-J"}
-    ]}"""
-
-@route("/api/gateway.php/" + TEST_COMPANY + "/v1/time_off/whos_out/")
-def whosout_request_handler():
-    return """[
-    {"id":121, "type":"timeoff", "employeeId":50446, "name": "Sarah Surely",
-     "start": "2015-05-4", "end": "2015-05-4"},
-    {"id":940, "type":"timeoff", "employeeId":60401, "name": "Charlie Brown",
-     "start": "2015-05-21", "end": "2015-05-28"}]"""
-
-def run_fn():
-    return bottle.run(host='localhost', port=8080, debug=True,
-                      server='gevent')
+class TestNameSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = NameSearchIndex(
+            ['alex', 'alexander', 'alexandra', 'jon', 'john', 'johnny', 'al'])
+
+    def test_search_exact(self):
+        self.assertIn(('alex', 0), self.index.search('alex'))
+
+    def test_search_prefix(self):
+        self.assertEqual({'alex': 1, 'alexander': 1, 'alexandra': 1},
+                         dict(self.index.search('ale')))
+
+    def test_starting_with_is_bounded(self):
+        self.assertEqual(['alexander', 'alexandra'],
+                         self.index.starting_with('alex'))
+        self.assertEqual(['alex', 'alexander'],
+                         self.index.starting_with('ale', limit=2))
+        index = NameSearchIndex(['smith{:05}'.format(i) for i in range(1000)])
+        self.assertEqual(whosout.MAX_PREFIX_MATCHES,
+                         len(index.search('smit')))
+
+    def test_search_misspelt(self):
+        self.assertEqual({'john': 2, 'jon': 2}, dict(self.index.search('jonh')))
+        self.assertEqual({'alexander': 2, 'alexandra': 1},
+                         dict(self.index.search('alexandr')))
+
+    def test_search_too_short(self):
+        self.assertEqual([], self.index.search('a'))
+        self.assertEqual([], self.index.search(''))
+
+class TestLeaveCache(unittest.TestCase):
+
+    def setUp(self):
+        self.fetches = 0
+        self.down = False
+        self.now = 0
+        self.today = date(2015, 5, 4)
+        self.cache = LeaveCache(self.fetch, ttl=60,
+                                clock=lambda: self.now,
+                                today=lambda: self.today)
+
+    def fetch(self):
+        self.fetches += 1
+        if self.down:
+            raise requests.exceptions.ConnectionError("BambooHR is down")
+        return {'snapshot': self.fetches}
+
+    def test_get_within_ttl_fetches_once(self):
+        self.assertEqual({'snapshot': 1}, self.cache.get())
+        self.now = 59
+        self.assertEqual({'snapshot': 1}, self.cache.get())
+        self.assertEqual(1, self.fetches)
+
+    def test_get_after_ttl_serves_stale_and_refreshes(self):
+        self.cache.get()
+        self.now = 61
+        self.assertEqual({'snapshot': 1}, self.cache.get())
+        gevent.sleep(0.01) # let the background refresh run
+        self.assertEqual(2, self.fetches)
+        self.assertEqual({'snapshot': 2}, self.cache.get())
+        self.assertEqual(2, self.cache.version)
+
+    def test_failed_background_refresh_retried_after_ttl(self):
+        self.cache.get()
+        self.down = True
+        self.now = 61
+        self.cache.get()
+        gevent.sleep(0.01) # let the background refresh fail
+        self.now = 120
+        self.assertEqual({'snapshot': 1}, self.cache.get())
+        gevent.sleep(0.01)
+        self.assertEqual(2, self.fetches)
+        self.now = 121
+        self.cache.get()
+        gevent.sleep(0.01)
+        self.assertEqual(3, self.fetches)
+
+    def test_get_after_date_rollover_refetches(self):
+        self.cache.get()
+        self.today += timedelta(1)
+        self.assertEqual({'snapshot': 2}, self.cache.get())
+
+    def test_failed_rollover_refresh_serves_usable_snapshot(self):
+        cache = LeaveCache(self.fetch, ttl=60, clock=lambda: self.now,
+                           today=lambda: self.today,
+                           usable=lambda snapshot, day: snapshot is usable)
+        usable = cache.get()
+        self.today += timedelta(1)
+        self.down = True
+        self.assertIs(usable, cache.get())
+        self.assertEqual(2, self.fetches)
+        # retried in the background once the TTL has passed
+        self.now = 59
+        self.assertIs(usable, cache.get())
+        self.assertEqual(2, self.fetches)
+        self.now = 60
+        self.down = False
+        self.assertIs(usable, cache.get())
+        gevent.sleep(0.01)
+        self.assertEqual({'snapshot': 3}, cache.get())
+
+    def test_failed_rollover_refresh_raises_without_usable_snapshot(self):
+        self.cache.get()
+        self.today += timedelta(1)
+        self.down = True
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.cache.get()
+
+    def test_invalidate(self):
+        self.cache.get()
+        self.cache.invalidate()
+        self.assertEqual({'snapshot': 2}, self.cache.get())
+
+class TestConditionalRefresh(unittest.TestCase):
+
+    def setUp(self):
+        CONDITIONAL_REQUESTS[:] = []
+
+    def test_refresh_not_modified_keeps_namesets_and_calendar(self):
+        checker = WhosOutChecker(TEST_API_KEY, CONDITIONAL_COMPANY, TEST_HOST)
+        namesets = checker.namesets
+        calendar = checker.leaves.peek()
+        checker.refresh_directory()
+        self.assertIs(namesets, checker.namesets)
+        self.assertIs(calendar, checker.leaves.refresh())
+        self.assertEqual(304, CONDITIONAL_REQUESTS[-1][2])
+
+    def test_reply_kept_across_not_modified_refresh(self):
+        checker = WhosOutChecker(TEST_API_KEY, CONDITIONAL_COMPANY, TEST_HOST)
+        reply = checker.get_whos_out_reply()
+        version = checker.leaves.version
+        checker.leaves.refresh()
+        self.assertEqual(304, CONDITIONAL_REQUESTS[-1][2])
+        self.assertEqual(version, checker.leaves.version)
+        self.assertIs(reply, checker.get_whos_out_reply())
 
 if __name__ == '__main__':
     GREENLET = gevent.spawn(run_fn)